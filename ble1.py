@@ -4,6 +4,7 @@
 import bluetooth_constants
 import bluetooth_gatt
 import bluetooth_exceptions
+import bluetooth_log
 import dbus
 import dbus.exceptions
 import dbus.service
@@ -19,6 +20,9 @@ adapter_path = None
 adv_mgr_interface = None
 connected = 0
 
+log = bluetooth_log.get_logger('gatt')
+adv_log = bluetooth_log.get_logger('adv')
+
 # much of this code was copied or inspired by test\example-advertisement in the BlueZ source
 class Advertisement(dbus.service.Object):
     PATH_BASE = '/org/bluez/ldsg/advertisement'
@@ -62,7 +66,7 @@ class Advertisement(dbus.service.Object):
         if self.data is not None:
             properties['Data'] = dbus.Dictionary(
                 self.data, signature='yv')
-        print(properties)
+        adv_log.debug("Advertisement properties: %s", properties)
         return {bluetooth_constants.ADVERTISING_MANAGER_INTERFACE: properties}
 
     def get_path(self):
@@ -80,52 +84,24 @@ class Advertisement(dbus.service.Object):
                          in_signature='',
                          out_signature='')
     def Release(self):
-        print('%s: Released' % self.path)
+        adv_log.info("%s: Released", self.path)
 
 
-class Application(dbus.service.Object):
-    """
-    org.bluez.GattApplication1 interface implementation
-    """
+class Application(bluetooth_gatt.Application):
     def __init__(self, bus):
-        self.path = '/'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-        print("Adding TemperatureService to the Application")
+        bluetooth_gatt.Application.__init__(self, bus)
+        log.info("Adding TemperatureService to the Application")
         self.add_service(TemperatureService(bus, '/org/bluez/ldsg', 0))
 
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_service(self, service):
-        self.services.append(service)
-
-    @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        print('GetManagedObjects')
-
-        for service in self.services:
-            print("GetManagedObjects: service="+service.get_path())
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-
-        return response
-
 class TemperatureService(bluetooth_gatt.Service):
 #   Fake micro:bit temperature service that simulates temperature sensor measurements
 #   ref: https://lancaster-university.github.io/microbit-docs/resources/bluetooth/bluetooth_profile.html
 #   temperature_period characteristic not implemented to keep things simple
 
      def __init__(self, bus, path_base, index):
-        print("Initialising TemperatureService object")
+        log.info("Initialising TemperatureService object")
         bluetooth_gatt.Service.__init__(self, bus, path_base, index, bluetooth_constants.TEMPERATURE_SVC_UUID, True)
-        print("Adding TemperatureCharacteristic to the service")
+        log.info("Adding TemperatureCharacteristic to the service")
         self.add_characteristic(TemperatureCharacteristic(bus, 0, self))
 
 class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
@@ -141,7 +117,7 @@ class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
                 service)
         self.notifying = False
         self.temperature = random.randint(0, 50)
-        print("Initial temperature set to "+str(self.temperature))
+        log.info("Initial temperature set to %s", self.temperature)
         self.delta = 0
         GLib.timeout_add(1000, self.simulate_temperature)
 
@@ -152,15 +128,15 @@ class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
             self.temperature = 50
         elif (self.temperature < 0):
             self.temperature = 0     
-        print("simulated temperature: "+str(self.temperature)+"C")
+        log.debug("simulated temperature: %sC", self.temperature)
         if self.notifying:
             self.notify_temperature()
 
         GLib.timeout_add(1000, self.simulate_temperature)
 
     def ReadValue(self, options):
-        print('ReadValue in TemperatureCharacteristic called')
-        print('Returning '+str(self.temperature))
+        log.debug("ReadValue in TemperatureCharacteristic called")
+        log.debug("Returning %s", self.temperature)
         value = []
         value.append(dbus.Byte(self.temperature))
         return value
@@ -172,41 +148,41 @@ class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
     def notify_temperature(self):
         value = []
         value.append(dbus.Byte(self.temperature))
-        print("notifying temperature="+str(self.temperature))
+        log.debug("notifying temperature=%s", self.temperature)
         self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, { 'Value': value }, [])
         return self.notifying
 
     # note this overrides the same method in bluetooth_gatt.Characteristic where it is exported to 
     # make it visible over DBus
     def StartNotify(self):
-        print("starting notifications")
+        log.info("starting notifications")
         self.notifying = True
 
     def StopNotify(self):
-        print("stopping notifications")
+        log.info("stopping notifications")
         self.notifying = False
 
 def register_ad_cb():
-    print('Advertisement registered OK')
+    adv_log.info("Advertisement registered OK")
 
 def register_ad_error_cb(error):
-    print('Error: Failed to register advertisement: ' + str(error))
+    adv_log.error("Failed to register advertisement: %s", error)
     mainloop.quit()
 
 def register_app_cb():
-    print('GATT application registered')
+    log.info("GATT application registered")
 
 def register_app_error_cb(error):
-    print('Failed to register application: ' + str(error))
+    log.error("Failed to register application: %s", error)
     mainloop.quit()
 
 def set_connected_status(status):
     if (status == 1):
-        print("connected")
+        log.info("connected")
         connected = 1
         stop_advertising()
     else:
-        print("disconnected")
+        log.info("disconnected")
         connected = 0
         start_advertising()
 
@@ -224,14 +200,14 @@ def interfaces_added(path, interfaces):
 def stop_advertising():
     global adv
     global adv_mgr_interface
-    print("Unregistering advertisement",adv.get_path())
+    adv_log.info("Unregistering advertisement %s", adv.get_path())
     adv_mgr_interface.UnregisterAdvertisement(adv.get_path())
 
 def start_advertising():
     global adv
     global adv_mgr_interface
     # we're only registering one advertisement object so index (arg2) is hard coded as 0
-    print("Registering advertisement",adv.get_path())
+    adv_log.info("Registering advertisement %s", adv.get_path())
     adv_mgr_interface.RegisterAdvertisement(adv.get_path(), {},
                                         reply_handler=register_ad_cb,
                                         error_handler=register_ad_error_cb)
@@ -261,7 +237,7 @@ mainloop = GLib.MainLoop()
 
 app = Application(bus)
 
-print('Registering GATT application...')
+log.info("Registering GATT application...")
 
 service_manager = dbus.Interface(
         bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_path),
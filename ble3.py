@@ -1,6 +1,7 @@
 import bluetooth_constants
 import bluetooth_gatt
 import bluetooth_exceptions
+import bluetooth_log
 import dbus
 import dbus.exceptions
 import dbus.service
@@ -15,6 +16,11 @@ adapter_path = None
 adv_mgr_interface = None
 connected = 0
 
+log = bluetooth_log.get_logger('gatt')
+adv_log = bluetooth_log.get_logger('adv')
+frame_log = bluetooth_log.get_logger('can.frames')
+notify_log = bluetooth_log.get_logger('can.notify')
+
 class Advertisement(dbus.service.Object):
     PATH_BASE = '/org/bluez/ldsg/advertisement'
 
@@ -52,7 +58,7 @@ class Advertisement(dbus.service.Object):
 
         if self.data is not None:
             properties['Data'] = dbus.Dictionary(self.data, signature='yv')
-        print(properties)
+        adv_log.debug("Advertisement properties: %s", properties)
         return {bluetooth_constants.ADVERTISING_MANAGER_INTERFACE: properties}
 
     def get_path(self):
@@ -66,46 +72,21 @@ class Advertisement(dbus.service.Object):
 
     @dbus.service.method(bluetooth_constants.ADVERTISING_MANAGER_INTERFACE, in_signature='', out_signature='')
     def Release(self):
-        print('%s: Released' % self.path)
+        adv_log.info("%s: Released", self.path)
 
 
-class Application(dbus.service.Object):
+class Application(bluetooth_gatt.Application):
     def __init__(self, bus):
-        self.path = '/'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-        print("Adding CANService to the Application")
+        bluetooth_gatt.Application.__init__(self, bus)
+        log.info("Adding CANService to the Application")
         self.add_service(CANService(bus, '/org/bluez/ldsg', 0))
 
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_service(self, service):
-        self.services.append(service)
-
-    @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        print('GetManagedObjects')
-
-        for service in self.services:
-            print("GetManagedObjects: service=" + service.get_path())
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-
-        return response
-
 
 class CANService(bluetooth_gatt.Service):
     def __init__(self, bus, path_base, index):
-        print("Initializing CANService object")
+        log.info("Initializing CANService object")
         bluetooth_gatt.Service.__init__(self, bus, path_base, index, '12345678-1234-5678-1234-56789abcdef0', True)
-        print("Adding CANCharacteristic to the service")
+        log.info("Adding CANCharacteristic to the service")
         self.add_characteristic(CANCharacteristic(bus, 0, self))
 
 
@@ -131,16 +112,16 @@ class CANCharacteristic(bluetooth_gatt.Characteristic):
         for msg in bus:
             can_data = bytearray(msg.data)
             self.value = list(can_data)
-            print(f"Received CAN data: {self.value}")
+            frame_log.debug("Received CAN data: %s", self.value)
             if self.notifying:
                 self.notify_can_data()
 
     def ReadValue(self, options):
-        print("ReadValue in CANCharacteristic called")
+        log.debug("ReadValue in CANCharacteristic called")
         return [dbus.Byte(v) for v in self.value]
 
     def notify_can_data(self):
-        print(f"Notifying CAN data: {self.value}")
+        notify_log.debug("Notifying CAN data: %s", self.value)
         self.PropertiesChanged(
             bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
             {'Value': dbus.Array(self.value, signature='y')},
@@ -148,36 +129,36 @@ class CANCharacteristic(bluetooth_gatt.Characteristic):
         )
 
     def StartNotify(self):
-        print("Starting CAN notifications")
+        log.info("Starting CAN notifications")
         self.notifying = True
 
     def StopNotify(self):
-        print("Stopping CAN notifications")
+        log.info("Stopping CAN notifications")
         self.notifying = False
 
 
 def register_ad_cb():
-    print('Advertisement registered OK')
+    adv_log.info("Advertisement registered OK")
 
 def register_ad_error_cb(error):
-    print('Error: Failed to register advertisement: ' + str(error))
+    adv_log.error("Failed to register advertisement: %s", error)
     mainloop.quit()
 
 def register_app_cb():
-    print('GATT application registered')
+    log.info("GATT application registered")
 
 def register_app_error_cb(error):
-    print('Failed to register application: ' + str(error))
+    log.error("Failed to register application: %s", error)
     mainloop.quit()
 
 def set_connected_status(status):
     global connected
     if status == 1:
-        print("connected")
+        log.info("connected")
         connected = 1
         stop_advertising()
     else:
-        print("disconnected")
+        log.info("disconnected")
         connected = 0
         start_advertising()
 
@@ -195,13 +176,13 @@ def interfaces_added(path, interfaces):
 def stop_advertising():
     global adv
     global adv_mgr_interface
-    print("Unregistering advertisement", adv.get_path())
+    adv_log.info("Unregistering advertisement %s", adv.get_path())
     adv_mgr_interface.UnregisterAdvertisement(adv.get_path())
 
 def start_advertising():
     global adv
     global adv_mgr_interface
-    print("Registering advertisement", adv.get_path())
+    adv_log.info("Registering advertisement %s", adv.get_path())
     adv_mgr_interface.RegisterAdvertisement(
         adv.get_path(), {},
         reply_handler=register_ad_cb,
@@ -230,7 +211,7 @@ mainloop = GLib.MainLoop()
 
 app = Application(bus)
 
-print('Registering GATT application...')
+log.info("Registering GATT application...")
 
 service_manager = dbus.Interface(
     bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_path),
@@ -1,13 +1,24 @@
 import bluetooth_constants
 import bluetooth_gatt
 import bluetooth_exceptions
+import bluetooth_log
+import can_bridge
+import can_compress
+import can_reader
+import can_sender
+import can_socket
+import can_replay
+import can_stats
+import can_wire
 import dbus
 import dbus.exceptions
 import dbus.service
 import dbus.mainloop.glib
+import struct
 import sys
-import can
 import threading
+import time
+import zlib
 from gi.repository import GLib
 
 bus = None
@@ -15,6 +26,91 @@ adapter_path = None
 adv_mgr_interface = None
 connected = 0
 
+log = bluetooth_log.get_logger('gatt')
+adv_log = bluetooth_log.get_logger('adv')
+bridge_log = bluetooth_log.get_logger('can')
+frame_log = bluetooth_log.get_logger('can.frames')
+notify_log = bluetooth_log.get_logger('can.notify')
+
+# CAN frames are packed into as few notifications as possible. A batch is sent once it fills
+# a notification sized for the ATT MTU or once BATCH_DELAY seconds have passed since its first frame.
+# Notifications are sized for BATCH_MTU until BlueZ has reported the MTU of a connected phone,
+# then for the smallest MTU of the connected phones.
+BATCH_NOTIFICATIONS = True
+BATCH_MTU = 185
+BATCH_DELAY = 0.010
+
+# BlueZ is offered a socket to take CAN frame notifications from (AcquireNotify) and one to
+# pass on the frames the phone writes (AcquireWrite), so those values skip D-Bus altogether.
+# Notifications go out as PropertiesChanged signals whenever BlueZ has not acquired the socket.
+ACQUIRE_SOCKETS = True
+
+# Encoding of the notified frames, can_wire.FORMAT_COMPACT or can_wire.FORMAT_LEGACY (see can_wire.py)
+WIRE_FORMAT = can_wire.FORMAT_COMPACT
+
+# The CAN buses to bridge. Each gets its own frames, control and statistics characteristics,
+# named by a Characteristic User Description descriptor. All buses are read on one thread.
+CAN_CHANNELS = ['can0']
+
+# How the buses are read, see can_reader.py. can_reader.BACKEND_SOCKET stamps frames with the
+# time the CAN controller received them when it supports hardware timestamps (CAN_TIMESTAMPS),
+# and with the kernel's receive time otherwise. The compact format carries them to the phone.
+# It also reads up to CAN_RECV_BATCH frames per system call, 1 reads them one at a time.
+CAN_BACKEND = can_reader.BACKEND_SOCKET
+CAN_TIMESTAMPS = can_socket.TIMESTAMP_HARDWARE
+CAN_RECV_BATCH = 64
+
+# Batches are deflated with the preset dictionary in can_zdict.bin once the phone reports through
+# the capability characteristic that it supports it (see can_compress.py).
+COMPRESSION = True
+
+# Frames read from the bus wait in a bounded ring until the main loop sends them. When the ring
+# is full either the oldest queued frame or the new one is dropped (can_bridge.DROP_NEWEST).
+QUEUE_SIZE = 4096
+QUEUE_OVERFLOW = can_bridge.DROP_OLDEST
+QUEUE_DRAIN_LIMIT = 512
+
+# The last HISTORY_FRAMES frames, going back at most HISTORY_SECONDS, are kept so a phone that
+# has just subscribed can ask for them through the control characteristic. The memory for them
+# is allocated at startup.
+HISTORY_FRAMES = 16384
+HISTORY_SECONDS = 30
+
+# In change-only mode a frame is only notified when its data differs from the last frame sent
+# with the same id, or when CHANGE_ONLY_KEEPALIVE seconds have passed since then. The phone can
+# also turn the mode on and off through the CAN control characteristic.
+CHANGE_ONLY = False
+CHANGE_ONLY_KEEPALIVE = 1.0
+
+# Frames the phone writes to the transmit characteristic wait in a queue of TX_QUEUE_SIZE for
+# the bus. The characteristic indicates a pause once TX_HIGH_WATERMARK frames are waiting and
+# that the phone may carry on once they are down to TX_LOW_WATERMARK.
+TX_QUEUE_SIZE = 1024
+TX_HIGH_WATERMARK = 768
+TX_LOW_WATERMARK = 256
+
+# Optional scheduling in front of the notifications. RATE_LIMIT caps the frames per second sent
+# for each id, DECIMATION keeps only every Nth frame of each id and LINK_RATE caps the frames per
+# second sent in total. Frames held back by LINK_RATE are sent round robin across ids so busy ids
+# cannot starve rare ones. None (or a DECIMATION of 1) turns a setting off.
+RATE_LIMIT = None
+DECIMATION = 1
+LINK_RATE = None
+
+# Set REPLAY_LOG to a candump log or CSV export to feed it into the bridge instead of reading
+# the first of CAN_CHANNELS, e.g. to try the phone app away from the vehicle. REPLAY_SPEED speeds it up, 0 sends the
+# frames as fast as possible. See can_replay.py.
+REPLAY_LOG = None
+REPLAY_SPEED = 1.0
+
+# The statistics characteristic notifies a summary of the bridge counters (STATS_SUMMARY, small
+# enough for the default ATT MTU) every STATS_INTERVAL seconds while subscribed, reads return
+# all of them. STATS_PORT serves them at http://127.0.0.1:STATS_PORT/metrics for Prometheus,
+# None turns that off. See can_stats.py for the format.
+STATS_INTERVAL = 1.0
+STATS_SUMMARY = ['frames_received', 'frames_dropped', 'frames_sent', 'queue_depth']
+STATS_PORT = 9108
+
 class Advertisement(dbus.service.Object):
     PATH_BASE = '/org/bluez/ldsg/advertisement'
 
@@ -22,7 +118,7 @@ class Advertisement(dbus.service.Object):
         self.path = self.PATH_BASE + str(index)
         self.bus = bus
         self.ad_type = advertising_type
-        self.service_uuids = ["12345678-1234-5678-1234-56789abcdef0"]
+        self.service_uuids = [bluetooth_constants.CAN_SVC_UUID]
         self.manufacturer_data = None
         self.solicit_uuids = None
         self.service_data = None
@@ -52,7 +148,7 @@ class Advertisement(dbus.service.Object):
 
         if self.data is not None:
             properties['Data'] = dbus.Dictionary(self.data, signature='yv')
-        print(properties)
+        adv_log.debug("Advertisement properties: %s", properties)
         return {bluetooth_constants.ADVERTISING_MANAGER_INTERFACE: properties}
 
     def get_path(self):
@@ -66,123 +162,582 @@ class Advertisement(dbus.service.Object):
 
     @dbus.service.method(bluetooth_constants.ADVERTISING_MANAGER_INTERFACE, in_signature='', out_signature='')
     def Release(self):
-        print('%s: Released' % self.path)
+        adv_log.info("%s: Released", self.path)
 
 
-class Application(dbus.service.Object):
+class Application(bluetooth_gatt.Application):
     def __init__(self, bus):
-        self.path = '/'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-        print("Adding CANService to the Application")
-        self.add_service(CANService(bus, '/org/bluez/ldsg', 0))
+        bluetooth_gatt.Application.__init__(self, bus)
+        log.info("Adding CANService to the Application")
+        service = CANService(bus, '/org/bluez/ldsg', 0, CAN_CHANNELS)
+        self.add_service(service)
+        self.can_characteristics = service.can_characteristics
+        for can_characteristic in service.can_characteristics:
+            self.add_mtu_listener(can_characteristic.set_mtu)
 
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
+    def forget_device(self, device):
+        bluetooth_gatt.Application.forget_device(self, device)
+        # the next phone negotiates its own encoding
+        for can_characteristic in self.can_characteristics:
+            can_characteristic.reset_encoding()
+
+
+class CANService(bluetooth_gatt.Service):
+    # One frames, control and statistics characteristic per CAN channel, and a capability
+    # characteristic shared by all of them. With a single channel the characteristics come in
+    # the same order as before channels were added.
+
+    def __init__(self, bus, path_base, index, channels):
+        log.info("Initializing CANService object")
+        bluetooth_gatt.Service.__init__(self, bus, path_base, index, bluetooth_constants.CAN_SVC_UUID, True)
+        self.can_characteristics = []
+        self.tx_characteristics = []
+        chr_index = 0
+        for channel in channels:
+            log.info("Adding CANCharacteristic for %s to the service", channel)
+            can_characteristic = CANCharacteristic(bus, chr_index, self, channel)
+            self.add_characteristic(can_characteristic)
+            self.can_characteristics.append(can_characteristic)
+            log.info("Adding CANControlCharacteristic for %s to the service", channel)
+            self.add_characteristic(CANControlCharacteristic(bus, chr_index + 1, self, can_characteristic))
+            chr_index += 2
+            if channel == channels[0]:
+                log.info("Adding CANCapabilityCharacteristic to the service")
+                self.add_characteristic(CANCapabilityCharacteristic(bus, chr_index, self, self.can_characteristics))
+                chr_index += 1
+            log.info("Adding CANStatsCharacteristic for %s to the service", channel)
+            self.add_characteristic(CANStatsCharacteristic(bus, chr_index, self, can_characteristic))
+            log.info("Adding CANTxCharacteristic for %s to the service", channel)
+            tx_characteristic = CANTxCharacteristic(bus, chr_index + 1, self, can_characteristic)
+            self.add_characteristic(tx_characteristic)
+            self.tx_characteristics.append(tx_characteristic)
+            log.info("Adding CANSnapshotCharacteristic for %s to the service", channel)
+            self.add_characteristic(CANSnapshotCharacteristic(bus, chr_index + 2, self, can_characteristic))
+            chr_index += 3
+        if STATS_PORT:
+            try:
+                can_stats.serve_prometheus([c.stats for c in self.can_characteristics], STATS_PORT)
+                bridge_log.info("Serving CAN statistics on port %d", STATS_PORT)
+            except OSError as e:
+                bridge_log.error("Cannot serve CAN statistics on port %d, carrying on without: %s", STATS_PORT, e)
+        self.start_can_readers()
+
+    def start_can_readers(self):
+        self.reader = can_reader.MultiBusReader(CAN_BACKEND, timestamps=CAN_TIMESTAMPS, batch=CAN_RECV_BATCH)
+        channels = list(zip(self.can_characteristics, self.tx_characteristics))
+        if REPLAY_LOG:
+            # a replayed channel has no bus to transmit on
+            channels[0][0].start_replay()
+            channels = channels[1:]
+        for can_characteristic, tx_characteristic in channels:
+            can_characteristic.bus_reader = self.reader.add(can_characteristic.channel, can_characteristic.ring)
+            can_characteristic.sender = can_sender.FrameSender(
+                can_characteristic.bus_reader, TX_QUEUE_SIZE, TX_HIGH_WATERMARK, TX_LOW_WATERMARK,
+                tx_characteristic.pause_changed)
+        self.reader.start()
+
+
+class ChannelDescriptor(bluetooth_gatt.Descriptor):
+    # Characteristic User Description naming the CAN channel a characteristic belongs to
+
+    def __init__(self, bus, index, characteristic, channel):
+        bluetooth_gatt.Descriptor.__init__(
+            self, bus, index,
+            bluetooth_constants.USER_DESCRIPTION_DSC_UUID,
+            ['read'],
+            characteristic
+        )
+        self.channel = channel
+
+    def ReadValue(self, options):
+        return dbus.ByteArray(self.channel.encode())
 
-    def add_service(self, service):
-        self.services.append(service)
 
-    @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        print('GetManagedObjects')
+class CANCharacteristic(bluetooth_gatt.Characteristic):
+    def __init__(self, bus, index, service, channel):
+        bluetooth_gatt.Characteristic.__init__(
+            self, bus, index,
+            bluetooth_constants.CAN_FRAMES_CHR_UUID,
+            ['read', 'notify'],
+            service
+        )
+        self.add_descriptor(ChannelDescriptor(bus, 0, self, channel))
+        self.acquire_notify = ACQUIRE_SOCKETS
+        self.channel = channel
+        self.notifying = False
+        self.value = None
+        self.bus_reader = None
+        self.sender = None
+        self.snapshot = can_bridge.SnapshotTable()
+        self.history = can_bridge.HistoryRing(HISTORY_FRAMES, HISTORY_SECONDS)
+        self.filters = []
+        self.encoder = can_wire.make_encoder(WIRE_FORMAT)
+        self.mtu = BATCH_MTU
+        batcher = can_bridge.FrameBatcher(self.mtu, BATCH_DELAY, can_wire.make_encoder(WIRE_FORMAT))
+        self.bridge = can_bridge.CanBridge(batcher, self.notify_can_data)
+        # a backfill goes no faster than the notification socket drains
+        self.bridge.ready = self.notify_ready
+        self.zdict = None
+        if COMPRESSION:
+            try:
+                self.zdict = can_compress.load_dictionary()
+            except OSError as e:
+                bridge_log.warning("%s: compression disabled, cannot load dictionary: %s", channel, e)
+        self.bridge.batching = BATCH_NOTIFICATIONS
+        if CHANGE_ONLY:
+            self.bridge.change_filter = can_bridge.ChangeFilter(CHANGE_ONLY_KEEPALIVE)
+        if RATE_LIMIT or DECIMATION > 1 or LINK_RATE:
+            self.bridge.scheduler = can_bridge.FairScheduler(RATE_LIMIT, DECIMATION, LINK_RATE)
+        self.bridge_timer = None
+        self.ring = can_bridge.FrameRing(QUEUE_SIZE, QUEUE_OVERFLOW)
+        self.queue_high = 0
+        self.stats = self.make_stats()
+        # frames are notified from the main loop which owns the dbus objects, never from the reader thread
+        GLib.io_add_watch(self.ring.fileno(), GLib.IO_IN, self.drain_ring)
+
+    def make_stats(self):
+        # the order of the metrics is the layout of the statistics characteristic value
+        stats = can_stats.Stats(labels={'channel': self.channel})
+        stats.counter('frames_received', "Frames read from the bus", lambda: self.ring.received)
+        stats.counter('frames_dropped', "Frames dropped because a queue was full",
+                      lambda: self.ring.dropped + self.bridge.frames_dropped)
+        stats.counter('frames_filtered', "Frames held back by change-only mode, decimation or rate limits", self.frames_filtered)
+        stats.counter('frames_sent', "Frames packed into notifications", lambda: self.bridge.frames_sent)
+        stats.counter('notifications', "Notifications sent", lambda: self.bridge.notifications)
+        stats.counter('notification_bytes', "Notification payload bytes sent", lambda: self.bridge.bytes_sent)
+        stats.gauge('queue_depth', "Frames waiting in the queue", lambda: len(self.ring))
+        stats.gauge('queue_depth_max', "Most frames seen waiting in the queue", lambda: self.queue_high)
+        self.queue_latency = stats.histogram('queue_latency', "Time the oldest frame of each drain spent queued")
+        self.process_time = stats.histogram('process_time', "Time taken to filter and pack each drain of frames")
+        self.notify_time = stats.histogram('notify_time', "Time taken to send each notification")
+        stats.counter('error_frames', "Error frames read from the bus",
+                      lambda: self.bus_reader.error_frames if self.bus_reader is not None else 0)
+        stats.counter('tx_frames', "Frames written by the phone and sent on the bus",
+                      lambda: self.sender.sent if self.sender is not None else 0)
+        stats.counter('tx_dropped', "Frames written by the phone while the transmit queue was full",
+                      lambda: self.sender.dropped if self.sender is not None else 0)
+        stats.counter('tx_errors', "Frames the bus failed to send",
+                      lambda: self.sender.errors if self.sender is not None else 0)
+        stats.counter('hw_timestamps', "Frames timestamped by the CAN controller",
+                      lambda: getattr(self.bus_reader, 'hardware_timestamps', 0))
+        stats.counter('notifications_dropped', "Notifications dropped because the notification socket was full",
+                      lambda: self.bridge.notifications_dropped)
+        return stats
+
+    def frames_filtered(self):
+        count = 0
+        if self.bridge.change_filter is not None:
+            count += self.bridge.change_filter.suppressed
+        if self.bridge.scheduler is not None:
+            count += self.bridge.scheduler.decimated + self.bridge.scheduler.rate_limited + self.bridge.scheduler.dropped
+        return count
+
+    def start_replay(self):
+        self.replay_thread = threading.Thread(target=self.replay_log)
+        self.replay_thread.daemon = True
+        self.replay_thread.start()
+
+    def replay_log(self):
+        # runs on its own thread in place of reading the bus, filters are not applied
+        bridge_log.info("%s: replaying %s at speed %s", self.channel, REPLAY_LOG, REPLAY_SPEED)
+        replayer = can_replay.Replayer(can_replay.read_frames(REPLAY_LOG), self.queue_frame, REPLAY_SPEED)
+        bridge_log.info("%s: replay finished: %s", self.channel, replayer.run().summary())
+
+    def queue_frame(self, can_id, data, timestamp):
+        # stamped with the time it is queued, like a live frame, so the phone sees a steady clock
+        self.ring.put((can_id, data, time.time()))
+
+    def drain_ring(self, source, condition):
+        now = time.monotonic()
+        depth = len(self.ring)
+        if depth > self.queue_high:
+            self.queue_high = depth
+        frames = self.ring.drain(QUEUE_DRAIN_LIMIT)
+        if frames:
+            self.value = frames[-1]
+            self.snapshot.update(frames)
+            self.history.extend(frames)
+            # socketcan timestamps are wall clock times, taken by the CAN controller with hardware timestamps
+            self.queue_latency.record(time.time() - frames[0][2])
+        if frame_log.isEnabledFor(bluetooth_log.DEBUG):
+            for can_id, data, timestamp in frames:
+                frame_log.debug("CAN Frame: (%.6f) %s %03X#%s", timestamp, self.channel, can_id & can_wire.CAN_EFF_MASK, data.hex().upper())
+
+        if self.notifying:
+            self.bridge.process(frames, now)
+            self.process_time.record(time.monotonic() - now)
+
+        if self.ring.dropped:
+            bridge_log.warning("%s: CAN queue overflow, %d frames dropped so far", self.channel, self.ring.dropped)
+        self.schedule_bridge_timer(now)
+        return True
+
+    def schedule_bridge_timer(self, now):
+        # make sure a part filled batch, or frames the scheduler held back, are sent in time
+        time_left = self.bridge.time_left(now)
+        if time_left is not None and self.bridge_timer is None:
+            self.bridge_timer = GLib.timeout_add(int(time_left * 1000) + 1, self.bridge_timer_expired)
+
+    def bridge_timer_expired(self):
+        self.bridge_timer = None
+        now = time.monotonic()
+        if self.notifying:
+            self.bridge.poll(now)
+        self.schedule_bridge_timer(now)
+        return False
+
+    def set_filters(self, filters):
+        # these are installed as CAN_RAW_FILTER so the kernel drops unwanted frames before they
+        # reach the reader thread. python-can falls back to filtering in software if that fails.
+        bridge_log.info("%s: setting CAN filters: %s", self.channel, filters)
+        self.filters = filters
+        if self.bus_reader is not None:
+            self.bus_reader.set_filters(filters)
+
+    def set_change_only(self, keepalive, overrides):
+        # a keep-alive of 0 turns change-only mode off
+        bridge_log.info("%s: setting change-only keep-alive to %ss, overrides %s", self.channel, keepalive, overrides)
+        if keepalive > 0:
+            self.bridge.change_filter = can_bridge.ChangeFilter(keepalive, overrides)
+        else:
+            self.bridge.change_filter = None
+
+    def backfill(self, seconds):
+        # sends the history, all of it when seconds is None, before any more live frames
+        bridge_log.info("%s: sending %s of history", self.channel, "%d s" % seconds if seconds else "all")
+        self.bridge.backfill(self.history.frames(seconds), time.monotonic())
+
+    def capabilities(self):
+        capabilities = can_compress.CAP_COMPACT
+        if self.zdict is not None:
+            capabilities |= can_compress.CAP_DEFLATE
+            return capabilities, can_compress.dictionary_id(self.zdict)
+        return capabilities, 0
+
+    def set_capabilities(self, capabilities, dictionary_id):
+        # picks the best encoding both sides support
+        if capabilities & can_compress.CAP_DEFLATE and self.zdict is not None \
+                and dictionary_id == can_compress.dictionary_id(self.zdict):
+            bridge_log.info("%s: phone supports compression, deflating CAN notifications", self.channel)
+            self.encoder = can_wire.CompactEncoder()
+            batcher = can_compress.CompressedBatcher(self.mtu, BATCH_DELAY, self.zdict)
+        else:
+            wire_format = can_wire.FORMAT_COMPACT if capabilities & can_compress.CAP_COMPACT else can_wire.FORMAT_LEGACY
+            bridge_log.info("%s: sending CAN notifications in %s format", self.channel, wire_format)
+            self.encoder = can_wire.make_encoder(wire_format)
+            batcher = can_bridge.FrameBatcher(self.mtu, BATCH_DELAY, can_wire.make_encoder(wire_format))
+        batcher.max_delay = self.bridge.batcher.max_delay
+        self.bridge.set_batcher(batcher)
+
+    def reset_encoding(self):
+        # back to WIRE_FORMAT until a subscriber writes its capabilities again
+        if type(self.bridge.batcher) is can_bridge.FrameBatcher \
+                and self.bridge.batcher.encoder.format == WIRE_FORMAT:
+            return
+        bridge_log.info("%s: sending CAN notifications in %s format", self.channel, WIRE_FORMAT)
+        self.encoder = can_wire.make_encoder(WIRE_FORMAT)
+        batcher = can_bridge.FrameBatcher(self.mtu, BATCH_DELAY, can_wire.make_encoder(WIRE_FORMAT))
+        batcher.max_delay = self.bridge.batcher.max_delay
+        self.bridge.set_batcher(batcher)
+
+    def set_mtu(self, mtu):
+        # called by the application when the smallest MTU of the connected devices changes,
+        # None once none is known
+        mtu = mtu or BATCH_MTU
+        if mtu == self.mtu:
+            return
+        bridge_log.info("%s: sizing CAN notifications for an MTU of %d", self.channel, mtu)
+        self.mtu = mtu
+        self.bridge.set_mtu(mtu)
 
-        for service in self.services:
-            print("GetManagedObjects: service=" + service.get_path())
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
+    def ReadValue(self, options):
+        log.debug("ReadValue in CANCharacteristic called")
+        self.update_mtu(options)
+        if self.value is None:
+            return dbus.ByteArray(b'')
+        can_id, data, timestamp = self.value
+        return dbus.ByteArray(self.encoder.encode(can_id, data, timestamp))
+
+    def notify_can_data(self, payload):
+        # payload is a memoryview into the batcher's buffers. It is written to the notification
+        # socket as is (copied while the socket is full), or copied once into the dbus.ByteArray
+        # of a PropertiesChanged signal. Returns False when it had to be dropped.
+        notify_log.debug("%s: notifying %d bytes of CAN data", self.channel, len(payload))
+        started = time.monotonic()
+        sent = self.send_notification(payload)
+        self.notify_time.record(time.monotonic() - started)
+        return sent
+
+    def notify_drained(self):
+        # the notification socket has room again, carry on with a backfill
+        now = time.monotonic()
+        if self.notifying:
+            self.bridge.resume(now)
+        self.schedule_bridge_timer(now)
 
-        return response
+    def StartNotify(self):
+        log.info("Starting CAN notifications for %s", self.channel)
+        # a new subscriber starts from a clean slate, e.g. change-only mode sends every id again
+        self.bridge.reset()
+        self.notifying = True
 
+    def StopNotify(self):
+        log.info("Stopping CAN notifications for %s", self.channel)
+        self.notifying = False
+        self.bridge.reset()
+        self.reset_encoding()
 
-class CANService(bluetooth_gatt.Service):
-    def __init__(self, bus, path_base, index):
-        print("Initializing CANService object")
-        bluetooth_gatt.Service.__init__(self, bus, path_base, index, '12345678-1234-5678-1234-56789abcdef0', True)
-        print("Adding CANCharacteristic to the service")
-        self.add_characteristic(CANCharacteristic(bus, 0, self))
 
+class CANControlCharacteristic(bluetooth_gatt.Characteristic):
+    # Writes start with an opcode byte. CONTROL_SET_FILTERS is followed by a list of
+    # 8 byte (id, mask) pairs, see can_bridge.decode_filters. CONTROL_SET_CHANGE_ONLY is followed
+    # by keep-alive settings, see can_bridge.decode_change_only. CONTROL_BACKFILL, optionally
+    # followed by a number of seconds, sends the recent history to a subscribed phone ahead of
+    # live frames, see can_bridge.decode_backfill. Reads return the active filters.
 
-class CANCharacteristic(bluetooth_gatt.Characteristic):
-    def __init__(self, bus, index, service):
+    def __init__(self, bus, index, service, can_characteristic):
         bluetooth_gatt.Characteristic.__init__(
             self, bus, index,
-            '12345678-1234-5678-1234-56789abcdef1',
+            bluetooth_constants.CAN_CONTROL_CHR_UUID,
+            ['read', 'write'],
+            service
+        )
+        self.add_descriptor(ChannelDescriptor(bus, 0, self, can_characteristic.channel))
+        self.can_characteristic = can_characteristic
+
+    def ReadValue(self, options):
+        log.debug("ReadValue in CANControlCharacteristic called")
+        self.update_mtu(options)
+        return dbus.ByteArray(can_bridge.encode_filters(self.can_characteristic.filters))
+
+    def WriteValue(self, value, options):
+        self.update_mtu(options)
+        value = bytes(value)
+        if len(value) == 0:
+            raise bluetooth_exceptions.InvalidValueLengthException()
+        opcode = value[0]
+        if opcode == can_bridge.CONTROL_SET_FILTERS:
+            try:
+                filters = can_bridge.decode_filters(value[1:])
+            except ValueError as e:
+                log.warning("Invalid CAN filter list: %s", e)
+                raise bluetooth_exceptions.InvalidValueLengthException()
+            self.can_characteristic.set_filters(filters)
+        elif opcode == can_bridge.CONTROL_SET_CHANGE_ONLY:
+            try:
+                keepalive, overrides = can_bridge.decode_change_only(value[1:])
+            except ValueError as e:
+                log.warning("Invalid change-only settings: %s", e)
+                raise bluetooth_exceptions.InvalidValueLengthException()
+            self.can_characteristic.set_change_only(keepalive, overrides)
+        elif opcode == can_bridge.CONTROL_BACKFILL:
+            try:
+                seconds = can_bridge.decode_backfill(value[1:])
+            except ValueError as e:
+                log.warning("Invalid backfill request: %s", e)
+                raise bluetooth_exceptions.InvalidValueLengthException()
+            if not self.can_characteristic.notifying:
+                raise bluetooth_exceptions.NotPermittedException()
+            self.can_characteristic.backfill(seconds)
+        else:
+            log.warning("Unknown CAN control opcode %d", opcode)
+            raise bluetooth_exceptions.NotSupportedException()
+
+
+class CANCapabilityCharacteristic(bluetooth_gatt.Characteristic):
+    # Reads return the encodings the bridge supports as a capability bit mask and the id of its
+    # compression dictionary. The phone writes back its own capabilities (and dictionary id) and
+    # from then on notifications use the best encoding both sides support, on every channel,
+    # until it unsubscribes or disconnects.
+
+    def __init__(self, bus, index, service, can_characteristics):
+        bluetooth_gatt.Characteristic.__init__(
+            self, bus, index,
+            bluetooth_constants.CAN_CAPABILITY_CHR_UUID,
+            ['read', 'write'],
+            service
+        )
+        self.can_characteristics = can_characteristics
+
+    def ReadValue(self, options):
+        log.debug("ReadValue in CANCapabilityCharacteristic called")
+        self.update_mtu(options)
+        capabilities, dictionary_id = self.can_characteristics[0].capabilities()
+        return dbus.ByteArray(can_compress.CAPABILITIES.pack(capabilities, dictionary_id))
+
+    def WriteValue(self, value, options):
+        self.update_mtu(options)
+        try:
+            capabilities, dictionary_id = can_compress.decode_capabilities(bytes(value))
+        except ValueError as e:
+            log.warning("Invalid capabilities: %s", e)
+            raise bluetooth_exceptions.InvalidValueLengthException()
+        for can_characteristic in self.can_characteristics:
+            can_characteristic.set_capabilities(capabilities, dictionary_id)
+
+
+class CANStatsCharacteristic(bluetooth_gatt.Characteristic):
+    # Reads return the bridge statistics, see can_stats.py for the layout. Like the snapshot,
+    # the value is built when a read starts at offset 0 and the rest of a long read is served
+    # from that copy. While subscribed the STATS_SUMMARY counters are notified every
+    # STATS_INTERVAL seconds.
+
+    def __init__(self, bus, index, service, can_characteristic):
+        bluetooth_gatt.Characteristic.__init__(
+            self, bus, index,
+            bluetooth_constants.CAN_STATS_CHR_UUID,
             ['read', 'notify'],
             service
         )
+        self.add_descriptor(ChannelDescriptor(bus, 0, self, can_characteristic.channel))
+        self.stats = can_characteristic.stats
+        self.value = b''
         self.notifying = False
-        self.value = []
-        self.start_can_listener()
-
-    def start_can_listener(self):
-        self.listener_thread = threading.Thread(target=self.listen_to_can)
-        self.listener_thread.daemon = True
-        self.listener_thread.start()
-
-    def listen_to_can(self):
-        bus = can.interface.Bus(channel='can0', bustype='socketcan')
-        for msg in bus:
-            can_id = msg.arbitration_id.to_bytes(4, byteorder='big')
-            can_length = len(msg.data).to_bytes(1, byteorder='big')
-            can_data = bytearray(msg.data)
-            
-            # Combine ID, length, and data
-            self.value = list(can_id + can_length + can_data)
-            print(f"Formatted CAN Frame: {self.value}")
-            
-            if self.notifying:
-                self.notify_can_data()
+        self.timer = None
 
     def ReadValue(self, options):
-        print("ReadValue in CANCharacteristic called")
-        return [dbus.Byte(v) for v in self.value]
-
-    def notify_can_data(self):
-        print(f"Notifying CAN data: {self.value}")
+        offset = int(options.get('offset', 0))
+        log.debug("ReadValue in CANStatsCharacteristic called, offset %d", offset)
+        self.update_mtu(options)
+        if offset == 0:
+            self.value = self.stats.encode()
+        elif offset > len(self.value):
+            raise bluetooth_exceptions.InvalidOffsetException()
+        return dbus.ByteArray(self.value[offset:])
+
+    def notify_stats(self):
         self.PropertiesChanged(
             bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
-            {'Value': dbus.Array(self.value, signature='y')},
+            {'Value': dbus.ByteArray(self.stats.encode_summary(STATS_SUMMARY))},
             []
         )
+        return True
 
     def StartNotify(self):
-        print("Starting CAN notifications")
+        if self.notifying:
+            return
+        log.info("Starting CAN statistics notifications")
         self.notifying = True
+        if self.timer is None:
+            self.timer = GLib.timeout_add(int(STATS_INTERVAL * 1000), self.notify_stats)
 
     def StopNotify(self):
-        print("Stopping CAN notifications")
+        log.info("Stopping CAN statistics notifications")
         self.notifying = False
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+
+class CANSnapshotCharacteristic(bluetooth_gatt.Characteristic):
+    # Reads return the latest frame of every id seen on the channel as one compact format
+    # payload, see can_bridge.SnapshotTable, so a phone that connects late learns the state of
+    # the bus in one read. The value is built when a read starts at offset 0 and the rest of a
+    # long read is served from that copy, so all parts come from the same snapshot.
+
+    def __init__(self, bus, index, service, can_characteristic):
+        bluetooth_gatt.Characteristic.__init__(
+            self, bus, index,
+            bluetooth_constants.CAN_SNAPSHOT_CHR_UUID,
+            ['read'],
+            service
+        )
+        self.add_descriptor(ChannelDescriptor(bus, 0, self, can_characteristic.channel))
+        self.can_characteristic = can_characteristic
+        self.snapshot = b''
+
+    def ReadValue(self, options):
+        offset = int(options.get('offset', 0))
+        log.debug("ReadValue in CANSnapshotCharacteristic called, offset %d", offset)
+        self.update_mtu(options)
+        if offset == 0:
+            self.snapshot = self.can_characteristic.snapshot.encode()
+        elif offset > len(self.snapshot):
+            raise bluetooth_exceptions.InvalidOffsetException()
+        return dbus.ByteArray(self.snapshot[offset:])
+
+
+class CANTxCharacteristic(bluetooth_gatt.Characteristic):
+    # The phone writes frames to send on the bus, without response, in any format the frames
+    # characteristic notifies (see can_wire.py and can_compress.py), so many frames go in one
+    # write. Timestamps in the write are ignored, frames are sent in order as soon as possible.
+    # Indications report the transmit status, can_sender.STATUS: a flags byte with bit 0 set
+    # while the phone should pause, the free queue slots and the frames dropped so far.
+
+    def __init__(self, bus, index, service, can_characteristic):
+        bluetooth_gatt.Characteristic.__init__(
+            self, bus, index,
+            bluetooth_constants.CAN_TX_CHR_UUID,
+            ['write-without-response', 'indicate'],
+            service
+        )
+        self.add_descriptor(ChannelDescriptor(bus, 0, self, can_characteristic.channel))
+        self.acquire_write = ACQUIRE_SOCKETS
+        self.can_characteristic = can_characteristic
+        self.indicating = False
+
+    def WriteValue(self, value, options):
+        self.update_mtu(options)
+        sender = self.can_characteristic.sender
+        if sender is None:
+            raise bluetooth_exceptions.NotPermittedException()
+        try:
+            frames = [(can_id, data) for timestamp_us, can_id, data in
+                      can_compress.decode(bytes(value), self.can_characteristic.zdict)]
+            for can_id, data in frames:
+                can_wire.check_frame(can_id, data)
+        except (ValueError, IndexError, struct.error, zlib.error) as e:
+            log.warning("Invalid CAN frames written for %s: %s", self.can_characteristic.channel, e)
+            raise bluetooth_exceptions.InvalidValueLengthException()
+        accepted = sender.put(frames)
+        if accepted < len(frames):
+            bridge_log.warning("%s: transmit queue full, %d frames dropped", self.can_characteristic.channel,
+                               len(frames) - accepted)
+
+    def pause_changed(self, paused):
+        # called by the sender, from its worker thread when resuming
+        GLib.idle_add(self.indicate_status)
+
+    def indicate_status(self):
+        if self.indicating:
+            self.PropertiesChanged(
+                bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                {'Value': dbus.ByteArray(self.can_characteristic.sender.status())},
+                []
+            )
+        return False
+
+    def StartNotify(self):
+        log.info("Starting CAN transmit indications for %s", self.can_characteristic.channel)
+        self.indicating = True
+
+    def StopNotify(self):
+        log.info("Stopping CAN transmit indications for %s", self.can_characteristic.channel)
+        self.indicating = False
 
 
 def register_ad_cb():
-    print('Advertisement registered OK')
+    adv_log.info("Advertisement registered OK")
 
 def register_ad_error_cb(error):
-    print('Error: Failed to register advertisement: ' + str(error))
+    adv_log.error("Failed to register advertisement: %s", error)
     mainloop.quit()
 
 def register_app_cb():
-    print('GATT application registered')
+    log.info("GATT application registered")
 
 def register_app_error_cb(error):
-    print('Failed to register application: ' + str(error))
+    log.error("Failed to register application: %s", error)
     mainloop.quit()
 
 def set_connected_status(status):
     global connected
     if status == 1:
-        print("connected")
+        log.info("connected")
         connected = 1
         stop_advertising()
     else:
-        print("disconnected")
+        log.info("disconnected")
         connected = 0
         start_advertising()
 
@@ -190,6 +745,8 @@ def properties_changed(interface, changed, invalidated, path):
     if interface == bluetooth_constants.DEVICE_INTERFACE:
         if "Connected" in changed:
             set_connected_status(changed["Connected"])
+            if not changed["Connected"]:
+                app.forget_device(path)
 
 def interfaces_added(path, interfaces):
     if bluetooth_constants.DEVICE_INTERFACE in interfaces:
@@ -200,13 +757,13 @@ def interfaces_added(path, interfaces):
 def stop_advertising():
     global adv
     global adv_mgr_interface
-    print("Unregistering advertisement", adv.get_path())
+    adv_log.info("Unregistering advertisement %s", adv.get_path())
     adv_mgr_interface.UnregisterAdvertisement(adv.get_path())
 
 def start_advertising():
     global adv
     global adv_mgr_interface
-    print("Registering advertisement", adv.get_path())
+    adv_log.info("Registering advertisement %s", adv.get_path())
     adv_mgr_interface.RegisterAdvertisement(
         adv.get_path(), {},
         reply_handler=register_ad_cb,
@@ -235,7 +792,7 @@ mainloop = GLib.MainLoop()
 
 app = Application(bus)
 
-print('Registering GATT application...')
+log.info("Registering GATT application...")
 
 service_manager = dbus.Interface(
     bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_path),
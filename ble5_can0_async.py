@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+#
+# asyncio version of the CAN frames path of ble5_can0.py, built on bluetooth_gatt_async.py.
+#
+# Reading the buses, batching, notifying and advertising all run on one event loop: each bus
+# socket is watched with loop.add_reader (can_reader.LoopReader) and the frames read go straight
+# into the CanBridge, with no reader thread, FrameRing or GLib main loop in between.
+#
+# Only the frames characteristic is served, with the same batching and wire format as
+# ble5_can0.py. The control, capability, statistics, transmit and snapshot characteristics are
+# still only in ble5_can0.py.
+#
+# Needs dbus-next and python-can (or only dbus-next with can_reader.BACKEND_SOCKET).
+
+import asyncio
+import time
+import bluetooth_constants
+import bluetooth_gatt_async
+import bluetooth_log
+import can_bridge
+import can_reader
+import can_socket
+import can_wire
+
+log = bluetooth_log.get_logger('gatt')
+bridge_log = bluetooth_log.get_logger('can')
+notify_log = bluetooth_log.get_logger('can.notify')
+
+# see ble5_can0.py
+BATCH_MTU = 185
+BATCH_DELAY = 0.010
+WIRE_FORMAT = can_wire.FORMAT_COMPACT
+CAN_CHANNELS = ['can0']
+CAN_BACKEND = can_reader.BACKEND_SOCKET
+CAN_TIMESTAMPS = can_socket.TIMESTAMP_HARDWARE
+CAN_RECV_BATCH = 64
+
+
+class Advertisement(bluetooth_gatt_async.Advertisement):
+    def __init__(self, bus, index, advertising_type):
+        bluetooth_gatt_async.Advertisement.__init__(self, bus, index, advertising_type)
+        self.service_uuids = [bluetooth_constants.CAN_SVC_UUID]
+        self.local_name = 'CAN Adapter'
+
+
+class CANService(bluetooth_gatt_async.Service):
+    # One frames characteristic per bus in channels
+
+    def __init__(self, bus, path_base, index, channels):
+        log.info("Initializing CANService object")
+        bluetooth_gatt_async.Service.__init__(self, bus, path_base, index, bluetooth_constants.CAN_SVC_UUID, True)
+        self.can_characteristics = []
+        for chr_index, channel in enumerate(channels):
+            log.info("Adding CANCharacteristic for %s to the service", channel)
+            can_characteristic = CANCharacteristic(bus, chr_index, self, channel)
+            self.add_characteristic(can_characteristic)
+            self.can_characteristics.append(can_characteristic)
+
+
+class ChannelDescriptor(bluetooth_gatt_async.Descriptor):
+    # Characteristic User Description naming the CAN channel a characteristic belongs to
+
+    def __init__(self, bus, index, characteristic, channel):
+        bluetooth_gatt_async.Descriptor.__init__(
+            self, bus, index,
+            bluetooth_constants.USER_DESCRIPTION_DSC_UUID,
+            ['read'],
+            characteristic
+        )
+        self.channel = channel
+
+    def ReadValue(self, options):
+        return self.channel.encode()
+
+
+class CANCharacteristic(bluetooth_gatt_async.Characteristic):
+    def __init__(self, bus, index, service, channel):
+        bluetooth_gatt_async.Characteristic.__init__(
+            self, bus, index,
+            bluetooth_constants.CAN_FRAMES_CHR_UUID,
+            ['read', 'notify'],
+            service
+        )
+        self.add_descriptor(ChannelDescriptor(bus, 0, self, channel))
+        self.channel = channel
+        self.notifying = False
+        self.value = None
+        self.encoder = can_wire.make_encoder(WIRE_FORMAT)
+        self.mtu = BATCH_MTU
+        batcher = can_bridge.FrameBatcher(self.mtu, BATCH_DELAY, can_wire.make_encoder(WIRE_FORMAT))
+        self.bridge = can_bridge.CanBridge(batcher, self.notify_can_data)
+        self.bridge_timer = None
+
+    def frames_received(self, frames):
+        # called by the LoopReader with everything read from the bus in one go
+        now = time.monotonic()
+        self.value = frames[-1]
+        if self.notifying:
+            self.bridge.process(frames, now)
+        self.schedule_bridge_timer(now)
+
+    def schedule_bridge_timer(self, now):
+        # make sure a part filled batch is sent in time
+        time_left = self.bridge.time_left(now)
+        if time_left is not None and self.bridge_timer is None:
+            self.bridge_timer = asyncio.get_running_loop().call_later(time_left, self.bridge_timer_expired)
+
+    def bridge_timer_expired(self):
+        self.bridge_timer = None
+        now = time.monotonic()
+        if self.notifying:
+            self.bridge.poll(now)
+        self.schedule_bridge_timer(now)
+
+    def update_mtu(self, options):
+        # sizes notifications for the MTU BlueZ reports with a read. Unlike ble5_can0.py this
+        # does not track several phones, the last one to read decides.
+        mtu = options.get('mtu')
+        if mtu is None or mtu == self.mtu:
+            return
+        bridge_log.info("%s: sizing CAN notifications for an MTU of %d", self.channel, mtu)
+        self.mtu = mtu
+        self.bridge.set_mtu(mtu)
+
+    def ReadValue(self, options):
+        log.debug("ReadValue in CANCharacteristic called")
+        self.update_mtu(options)
+        if self.value is None:
+            return b''
+        can_id, data, timestamp = self.value
+        return self.encoder.encode(can_id, data, timestamp)
+
+    def notify_can_data(self, payload):
+        notify_log.debug("%s: notifying %d bytes of CAN data", self.channel, len(payload))
+        self.notify(payload)
+
+    def StartNotify(self):
+        log.info("Starting CAN notifications for %s", self.channel)
+        self.bridge.reset()
+        self.notifying = True
+
+    def StopNotify(self):
+        log.info("Stopping CAN notifications for %s", self.channel)
+        self.notifying = False
+        self.bridge.reset()
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    bus = await bluetooth_gatt_async.connect()
+    app = bluetooth_gatt_async.Application(bus)
+    service = CANService(bus, '/org/bluez/ldsg', 0, CAN_CHANNELS)
+    app.add_service(service)
+    reader = can_reader.LoopReader(loop, CAN_BACKEND, timestamps=CAN_TIMESTAMPS, batch=CAN_RECV_BATCH)
+    for can_characteristic in service.can_characteristics:
+        reader.add(can_characteristic.channel, can_characteristic.frames_received)
+    try:
+        log.info("Registering GATT application...")
+        await bluetooth_gatt_async.register_application(bus, app)
+        await bluetooth_gatt_async.register_advertisement(bus, Advertisement(bus, 0, 'peripheral'))
+        await loop.create_future()
+    finally:
+        reader.stop()
+
+
+asyncio.run(main())
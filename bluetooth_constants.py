@@ -49,8 +49,15 @@ UUID_NAMES = {
     "e95dda91-251d-470a-a062-fa1922dfa9a8" : "Button B State",
     "e95d9250-251d-470a-a062-fa1922dfa9a8" : "Temperature",
     "e95d93ee-251d-470a-a062-fa1922dfa9a8" : "LED Text",
+    "00002901-0000-1000-8000-00805f9b34fb" : "Characteristic User Description",
     "00002902-0000-1000-8000-00805f9b34fb" : "Client Characteristic Configuration",
     "12345678-1234-5678-1234-56789abcdef0" : "CAN Frames",
+    "12345678-1234-5678-1234-56789abcdef1" : "CAN Frame Data",
+    "12345678-1234-5678-1234-56789abcdef2" : "CAN Control",
+    "12345678-1234-5678-1234-56789abcdef3" : "CAN Capabilities",
+    "12345678-1234-5678-1234-56789abcdef4" : "CAN Statistics",
+    "12345678-1234-5678-1234-56789abcdef5" : "CAN Transmit",
+    "12345678-1234-5678-1234-56789abcdef6" : "CAN Snapshot",
 }    
 
 DEVICE_INF_SVC_UUID = "0000180a-0000-1000-8000-00805f9b34fb"
@@ -61,3 +68,13 @@ TEMPERATURE_CHR_UUID = "e95d9250-251d-470a-a062-fa1922dfa9a8"
 
 LED_SVC_UUID = "e95dd91d-251d-470a-a062-fa1922dfa9a8"
 LED_TEXT_CHR_UUID = "e95d93ee-251d-470a-a062-fa1922dfa9a8"
+
+USER_DESCRIPTION_DSC_UUID = "00002901-0000-1000-8000-00805f9b34fb"
+
+CAN_SVC_UUID = "12345678-1234-5678-1234-56789abcdef0"
+CAN_FRAMES_CHR_UUID = "12345678-1234-5678-1234-56789abcdef1"
+CAN_CONTROL_CHR_UUID = "12345678-1234-5678-1234-56789abcdef2"
+CAN_CAPABILITY_CHR_UUID = "12345678-1234-5678-1234-56789abcdef3"
+CAN_STATS_CHR_UUID = "12345678-1234-5678-1234-56789abcdef4"
+CAN_TX_CHR_UUID = "12345678-1234-5678-1234-56789abcdef5"
+CAN_SNAPSHOT_CHR_UUID = "12345678-1234-5678-1234-56789abcdef6"
@@ -1,18 +1,143 @@
 #!/usr/bin/python3
 #
 # Defines Services, Characteristic and Descriptor classes which should be extended to make concrete
-# GATT attributes of specific types by Applications
+# GATT attributes of specific types by Applications, and the Application which is registered
+# with BlueZ and holds them
 #
 # This code largely originates from test/example-gatt-server in the BlueZ source
+#
+# Simple attribute trees can also be declared in a JSON or YAML schema (YAML needs PyYAML) and
+# built with build_application(), see the end of this file.
 
 import dbus
 import dbus.exceptions
 import dbus.service
+import collections
+import json
+import socket
+import uuid
 import bluetooth_constants
 import bluetooth_exceptions
+import bluetooth_log
 import sys
+from gi.repository import GLib
 sys.path.insert(0, '.')
 
+log = bluetooth_log.get_logger('gatt')
+
+MAX_VALUE_SIZE = 512    # longest attribute value ATT allows
+NOTIFY_QUEUE_SIZE = 128 # notifications kept while the notification socket is full
+
+
+def walk(attribute):
+    # the attribute followed by everything below it, parents before their children
+    yield attribute
+    if isinstance(attribute, Service):
+        for chrc in attribute.characteristics:
+            yield from walk(chrc)
+    elif isinstance(attribute, Characteristic):
+        for desc in attribute.descriptors:
+            yield from walk(desc)
+
+
+class Application(dbus.service.Object):
+    """
+    org.freedesktop.DBus.ObjectManager of a GATT application
+
+    The GetManagedObjects response is built once and kept until the attribute tree changes.
+    Services, characteristics and descriptors added or removed once BlueZ has fetched the tree
+    (its first GetManagedObjects call, made when the application is registered) are announced
+    with InterfacesAdded and InterfacesRemoved. Until then the response covers them.
+
+    It also keeps the ATT MTU of each connected device, learnt from the options BlueZ passes
+    to reads, writes and the Acquire methods (see Characteristic.update_mtu). Listeners are
+    called with notify_mtu() whenever that changes.
+    """
+    def __init__(self, bus, path='/'):
+        self.path = path
+        self.services = []
+        self.managed_objects = None
+        self.published = False
+        self.mtus = {}          # device path -> MTU
+        self.mtu_listeners = []
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_service(self, service):
+        self.services.append(service)
+        service.application = self
+        self.attribute_added(service)
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        service.application = None
+        self.invalidate()
+        for attribute in reversed(list(walk(service))):
+            if self.published:
+                self.InterfacesRemoved(attribute.get_path(), list(attribute.get_properties().keys()))
+            attribute.remove_from_connection()
+
+    def attribute_added(self, attribute):
+        self.invalidate()
+        if not self.published:
+            return
+        for added in walk(attribute):
+            self.InterfacesAdded(added.get_path(), added.get_properties())
+
+    def invalidate(self):
+        # call after changing the properties of an attribute
+        self.managed_objects = None
+
+    def update_mtu(self, options):
+        device = options.get('device')
+        mtu = options.get('mtu')
+        if device is None or mtu is None or self.mtus.get(device) == int(mtu):
+            return
+        self.mtus[device] = int(mtu)
+        log.info("%s: MTU %d", device, mtu)
+        self.mtu_changed()
+
+    def forget_device(self, device):
+        # call when a device disconnects
+        if self.mtus.pop(device, None) is not None:
+            self.mtu_changed()
+
+    def notify_mtu(self):
+        # notifications go to every subscribed device, so they must fit the smallest MTU.
+        # None until a device's MTU is known.
+        return min(self.mtus.values()) if self.mtus else None
+
+    def add_mtu_listener(self, listener):
+        self.mtu_listeners.append(listener)
+
+    def mtu_changed(self):
+        mtu = self.notify_mtu()
+        for listener in self.mtu_listeners:
+            listener(mtu)
+
+    @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        log.debug("GetManagedObjects")
+        if self.managed_objects is None:
+            response = {}
+            for service in self.services:
+                for attribute in walk(service):
+                    response[attribute.get_path()] = attribute.get_properties()
+            self.managed_objects = response
+        self.published = True
+        return self.managed_objects
+
+    @dbus.service.signal(bluetooth_constants.DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(bluetooth_constants.DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+
 class Service(dbus.service.Object):
     """
     org.bluez.GattService1 interface implementation
@@ -24,6 +149,7 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.application = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -42,6 +168,8 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        if self.application is not None:
+            self.application.attribute_added(characteristic)
 
     def get_characteristic_paths(self):
         result = []
@@ -65,34 +193,62 @@ class Service(dbus.service.Object):
 class Characteristic(dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    A subclass sets acquire_notify to offer BlueZ a socket for its notifications
+    (AcquireNotify) and acquire_write to take write-without-response writes through one
+    (AcquireWrite), skipping a D-Bus message per value. Once BlueZ has acquired the
+    notification socket, StartNotify is called and send_notification() writes to the
+    socket; StopNotify is called when BlueZ closes it. Until then, and with BlueZ versions
+    that never acquire it, send_notification() sends PropertiesChanged signals. Each packet
+    written through the write socket is passed to WriteValue.
+
+    Notifications that do not fit in the notification socket wait in a queue of up to
+    NOTIFY_QUEUE_SIZE and are written as it drains, after which notify_drained() is called.
+    Once the queue is full send_notification() drops them and returns False.
     """
+    acquire_notify = False
+    acquire_write = False
+
     def __init__(self, bus, index, uuid, flags, service):
         self.path = service.path + '/char' + str(index)
-        print("creating Characteristic with path="+self.path)
+        log.debug("creating Characteristic with path=%s", self.path)
         self.bus = bus
         self.uuid = uuid
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.notify_socket = None
+        self.notify_watch = None
+        self.notify_mtu = None
+        self.notify_queue = collections.deque()
+        self.notify_out_watch = None
+        self.write_socket = None
+        self.write_watch = None
+        self.write_options = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-                bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
+        properties = {
+                'Service': self.service.get_path(),
+                'UUID': self.uuid,
+                'Flags': self.flags,
+                'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
         }
+        if self.acquire_notify:
+            properties['NotifyAcquired'] = dbus.Boolean(self.notify_socket is not None)
+        if self.acquire_write:
+            properties['WriteAcquired'] = dbus.Boolean(self.write_socket is not None)
+        return {bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        if self.service.application is not None:
+            self.service.application.attribute_added(descriptor)
 
     def get_descriptor_paths(self):
         result = []
@@ -116,24 +272,183 @@ class Characteristic(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
+        log.warning("Default ReadValue called, returning error")
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        log.warning("Default WriteValue called, returning error")
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
     def StartNotify(self):
-        print('Default StartNotify called, returning error')
+        log.warning("Default StartNotify called, returning error")
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
     def StopNotify(self):
-        print('Default StopNotify called, returning error')
+        log.warning("Default StopNotify called, returning error")
         raise bluetooth_exceptions.NotSupportedException()
 
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        if not self.acquire_notify:
+            raise bluetooth_exceptions.NotSupportedException()
+        if self.notify_socket is not None:
+            raise bluetooth_exceptions.NotPermittedException()
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.setblocking(False)
+        self.notify_socket = ours
+        self.notify_mtu = int(options.get('mtu', 23))
+        self.update_mtu(options)
+        self.notify_watch = GLib.io_add_watch(ours.fileno(), GLib.IO_HUP | GLib.IO_ERR, self.notify_socket_closed)
+        # UnixFd keeps its own copy of the descriptor for BlueZ
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        log.info("%s: notifications acquired, MTU %d", self.path, self.notify_mtu)
+        self.acquired_changed('NotifyAcquired', True)
+        self.StartNotify()
+        return fd, dbus.UInt16(self.notify_mtu)
+
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireWrite(self, options):
+        if not self.acquire_write:
+            raise bluetooth_exceptions.NotSupportedException()
+        if self.write_socket is not None:
+            raise bluetooth_exceptions.NotPermittedException()
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.setblocking(False)
+        self.write_socket = ours
+        self.write_options = dict(options)
+        self.update_mtu(options)
+        self.write_watch = GLib.io_add_watch(ours.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                                             self.write_socket_ready)
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        mtu = int(options.get('mtu', 23))
+        log.info("%s: writes acquired, MTU %d", self.path, mtu)
+        self.acquired_changed('WriteAcquired', True)
+        return fd, dbus.UInt16(mtu)
+
+    def update_mtu(self, options):
+        # records the device's MTU from the options of a method call
+        if self.service.application is not None:
+            self.service.application.update_mtu(options)
+
+    def acquired_changed(self, name, acquired):
+        if self.service.application is not None:
+            self.service.application.invalidate()
+        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                               {name: dbus.Boolean(acquired)}, [])
+
+    def send_notification(self, value):
+        # returns False when the notification had to be dropped
+        if self.notify_socket is None:
+            self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                                   {'Value': dbus.ByteArray(value)}, [])
+            return True
+        if not self.notify_queue:
+            try:
+                self.notify_socket.send(value)
+                return True
+            except BlockingIOError:
+                self.notify_out_watch = GLib.io_add_watch(self.notify_socket.fileno(), GLib.IO_OUT,
+                                                          self.notify_socket_writable)
+            except OSError as e:
+                log.info("%s: notification socket closed: %s", self.path, e)
+                self.release_notify()
+                return False
+        if len(self.notify_queue) >= NOTIFY_QUEUE_SIZE:
+            log.warning("%s: notification queue full, notification dropped", self.path)
+            return False
+        # value may be a view of a buffer the caller reuses
+        self.notify_queue.append(bytes(value))
+        return True
+
+    def notify_ready(self):
+        # whether a notification sent now goes out straight away
+        return not self.notify_queue
+
+    def notify_socket_writable(self, fd, condition):
+        queue = self.notify_queue
+        while queue:
+            try:
+                self.notify_socket.send(queue[0])
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                log.info("%s: notification socket closed: %s", self.path, e)
+                self.notify_out_watch = None
+                self.release_notify()
+                return False
+            queue.popleft()
+        self.notify_out_watch = None
+        self.notify_drained()
+        return False
+
+    def notify_drained(self):
+        # called once the notifications queued while the socket was full have all been written
+        pass
+
+    def notify_socket_closed(self, fd, condition):
+        self.notify_watch = None
+        self.release_notify()
+        return False
+
+    def release_notify(self):
+        if self.notify_socket is None:
+            return
+        if self.notify_watch is not None:
+            GLib.source_remove(self.notify_watch)
+            self.notify_watch = None
+        if self.notify_out_watch is not None:
+            GLib.source_remove(self.notify_out_watch)
+            self.notify_out_watch = None
+        self.notify_queue.clear()
+        self.notify_socket.close()
+        self.notify_socket = None
+        log.info("%s: notifications released", self.path)
+        self.acquired_changed('NotifyAcquired', False)
+        self.StopNotify()
+
+    def write_socket_ready(self, fd, condition):
+        if condition & GLib.IO_IN:
+            while True:
+                try:
+                    value = self.write_socket.recv(MAX_VALUE_SIZE)
+                except BlockingIOError:
+                    return True
+                except OSError:
+                    break
+                if not value:
+                    break
+                # there is no reply to send an error back with, so it is logged and the socket
+                # stays open for the next write
+                try:
+                    self.WriteValue(value, self.write_options)
+                except dbus.exceptions.DBusException as e:
+                    log.warning("%s: write through socket failed: %s", self.path, e.get_dbus_name())
+                except Exception:
+                    log.exception("%s: write through socket failed", self.path)
+        self.write_watch = None
+        self.release_write()
+        return False
+
+    def release_write(self):
+        if self.write_socket is None:
+            return
+        if self.write_watch is not None:
+            GLib.source_remove(self.write_watch)
+            self.write_watch = None
+        self.write_socket.close()
+        self.write_socket = None
+        log.info("%s: writes released", self.path)
+        self.acquired_changed('WriteAcquired', False)
+
     @dbus.service.signal(bluetooth_constants.DBUS_PROPERTIES,
                          signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
@@ -177,10 +492,284 @@ class Descriptor(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
+        log.warning("Default ReadValue called, returning error")
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_DESCRIPTOR_INTERFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        log.warning("Default WriteValue called, returning error")
         raise bluetooth_exceptions.NotSupportedException()
+
+
+# Declarative attribute trees. A schema is a dict, usually loaded from a file with
+# load_schema(), of the form:
+#
+#   services:
+#     - uuid: 12345678-1234-5678-1234-56789abcdef0
+#       primary: true
+#       characteristics:
+#         - uuid: 12345678-1234-5678-1234-56789abcdef1
+#           flags: [read, notify]
+#           read: read_frames              # names of callables in the handlers dict
+#           start_notify: frames_started
+#           descriptors:
+#             - uuid: '2901'               # 16 bit UUIDs are expanded
+#               flags: [read]
+#               value: CAN frames          # a fixed value, text or a list of byte values
+#
+# UUIDs are strings. Quote short ones in YAML: unquoted, 2901 is read as a decimal number and
+# is rejected rather than silently turned into another UUID.
+#
+# Handlers are called with the attribute first: read(attribute, options) returns the value,
+# write(attribute, value, options), start_notify(attribute) and stop_notify(attribute).
+# Characteristics track StartNotify and StopNotify themselves and send values with notify().
+# The whole schema is checked before any D-Bus object is made, and the property dicts
+# GetManagedObjects and GetAll return are computed once the tree is complete.
+
+CHARACTERISTIC_FLAGS = frozenset([
+    'broadcast', 'read', 'write-without-response', 'write', 'notify', 'indicate',
+    'authenticated-signed-writes', 'extended-properties', 'reliable-write', 'writable-auxiliaries',
+    'encrypt-read', 'encrypt-write', 'encrypt-authenticated-read', 'encrypt-authenticated-write',
+    'secure-read', 'secure-write', 'authorize'])
+DESCRIPTOR_FLAGS = frozenset([
+    'read', 'write', 'encrypt-read', 'encrypt-write', 'encrypt-authenticated-read',
+    'encrypt-authenticated-write', 'secure-read', 'secure-write', 'authorize'])
+READ_FLAGS = frozenset(['read', 'encrypt-read', 'encrypt-authenticated-read', 'secure-read'])
+WRITE_FLAGS = frozenset(['write', 'write-without-response', 'reliable-write', 'encrypt-write',
+                         'encrypt-authenticated-write', 'secure-write'])
+NOTIFY_FLAGS = frozenset(['notify', 'indicate'])
+HANDLERS = ('read', 'write', 'start_notify', 'stop_notify')
+BASE_UUID = '-0000-1000-8000-00805f9b34fb'     # of the Bluetooth SIG's 16 and 32 bit UUIDs
+
+
+def load_schema(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml     # PyYAML, only needed for YAML schemas
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def full_uuid(value):
+    # '2901' -> '00002901-0000-1000-8000-00805f9b34fb', raises ValueError if invalid
+    if not isinstance(value, str):
+        raise ValueError("UUID %r is not a string" % (value,))
+    if len(value) in (4, 8):
+        value = value.rjust(8, '0') + BASE_UUID
+    return str(uuid.UUID(value))
+
+
+def fixed_value(value):
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+
+def check_schema(schema, handlers):
+    # returns the list of everything wrong with schema, each with the path to the bad entry
+    # (e.g. services[0].characteristics[1]), empty if it can be built
+    errors = []
+
+    def entries(where, entry, key):
+        # the list entry[key] holds, [] if it is missing or not a list of dicts
+        children = entry.get(key, [])
+        if not isinstance(children, list):
+            errors.append("%s.%s: must be a list" % (where, key))
+            return []
+        valid = []
+        for i, child in enumerate(children):
+            if isinstance(child, dict):
+                valid.append(("%s.%s[%d]" % (where, key, i), child))
+            else:
+                errors.append("%s.%s[%d]: must be a mapping" % (where, key, i))
+        return valid
+
+    def check_uuid(where, entry):
+        if 'uuid' not in entry:
+            errors.append("%s: missing uuid" % where)
+            return
+        try:
+            full_uuid(entry['uuid'])
+        except ValueError as e:
+            errors.append("%s: invalid uuid: %s" % (where, e))
+
+    def check_attribute(where, entry, allowed):
+        check_uuid(where, entry)
+        flags = entry.get('flags', [])
+        if not isinstance(flags, list) or not all(isinstance(flag, str) for flag in flags):
+            errors.append("%s.flags: must be a list of names" % where)
+            flags = []
+        for flag in sorted(set(flags) - allowed):
+            errors.append("%s.flags: unknown flag '%s'" % (where, flag))
+        for name in HANDLERS:
+            if name not in entry:
+                continue
+            if not isinstance(entry[name], str):
+                errors.append("%s.%s: must be a handler name" % (where, name))
+            elif not callable(handlers.get(entry[name])):
+                errors.append("%s.%s: no handler '%s'" % (where, name, entry[name]))
+        if 'value' in entry:
+            try:
+                fixed_value(entry['value'])
+            except (TypeError, ValueError):
+                errors.append("%s.value: must be text or a list of byte values" % where)
+        if READ_FLAGS & set(flags) and 'read' not in entry and 'value' not in entry:
+            errors.append("%s: readable but has no read handler or value" % where)
+        if WRITE_FLAGS & set(flags) and 'write' not in entry:
+            errors.append("%s: writable but has no write handler" % where)
+
+    if not isinstance(schema, dict):
+        return ["schema must be a mapping with a list of services"]
+    services = entries('schema', schema, 'services')
+    if not services and not errors:
+        errors.append("schema.services: no services")
+    for where, service in services:
+        check_uuid(where, service)
+        if not isinstance(service.get('primary', True), bool):
+            errors.append("%s.primary: must be true or false" % where)
+        for chrc_where, chrc in entries(where, service, 'characteristics'):
+            check_attribute(chrc_where, chrc, CHARACTERISTIC_FLAGS)
+            for desc_where, desc in entries(chrc_where, chrc, 'descriptors'):
+                check_attribute(desc_where, desc, DESCRIPTOR_FLAGS)
+    return errors
+
+
+class SchemaService(Service):
+    """
+    Service built from a schema, with properties computed once by freeze()
+    """
+    properties = None
+
+    def freeze(self):
+        self.properties = Service.get_properties(self)
+
+    def get_properties(self):
+        return self.properties or Service.get_properties(self)
+
+
+class SchemaCharacteristic(Characteristic):
+    """
+    Characteristic built from a schema, calling the handlers it names
+    """
+    properties = None
+
+    def __init__(self, bus, index, uuid, flags, service, handlers, value=None):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.handlers = handlers
+        self.value = value
+        self.notifying = False
+
+    def freeze(self):
+        self.properties = Characteristic.get_properties(self)
+
+    def get_properties(self):
+        return self.properties or Characteristic.get_properties(self)
+
+    def notify(self, value):
+        if not self.notifying:
+            return
+        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                               {'Value': dbus.ByteArray(value)}, [])
+
+    def ReadValue(self, options):
+        if 'read' in self.handlers:
+            return dbus.ByteArray(self.handlers['read'](self, options))
+        if self.value is not None:
+            return dbus.ByteArray(self.value)
+        return Characteristic.ReadValue(self, options)
+
+    def WriteValue(self, value, options):
+        if 'write' not in self.handlers:
+            return Characteristic.WriteValue(self, value, options)
+        self.handlers['write'](self, bytes(value), options)
+
+    def StartNotify(self):
+        if not NOTIFY_FLAGS & set(self.flags):
+            return Characteristic.StartNotify(self)
+        self.notifying = True
+        if 'start_notify' in self.handlers:
+            self.handlers['start_notify'](self)
+
+    def StopNotify(self):
+        if not NOTIFY_FLAGS & set(self.flags):
+            return Characteristic.StopNotify(self)
+        self.notifying = False
+        if 'stop_notify' in self.handlers:
+            self.handlers['stop_notify'](self)
+
+
+class SchemaDescriptor(Descriptor):
+    """
+    Descriptor built from a schema, calling the handlers it names
+    """
+    properties = None
+
+    def __init__(self, bus, index, uuid, flags, characteristic, handlers, value=None):
+        Descriptor.__init__(self, bus, index, uuid, flags, characteristic)
+        self.handlers = handlers
+        self.value = value
+
+    def freeze(self):
+        self.properties = Descriptor.get_properties(self)
+
+    def get_properties(self):
+        return self.properties or Descriptor.get_properties(self)
+
+    def ReadValue(self, options):
+        if 'read' in self.handlers:
+            return dbus.ByteArray(self.handlers['read'](self, options))
+        if self.value is not None:
+            return dbus.ByteArray(self.value)
+        return Descriptor.ReadValue(self, options)
+
+    def WriteValue(self, value, options):
+        if 'write' not in self.handlers:
+            return Descriptor.WriteValue(self, value, options)
+        self.handlers['write'](self, bytes(value), options)
+
+
+def attribute_handlers(entry, handlers):
+    return {name: handlers[entry[name]] for name in HANDLERS if name in entry}
+
+
+def build_application(bus, schema, handlers=None, path_base='/org/bluez/ldsg', application=None):
+    # Builds the attribute tree described by schema, a dict or the path of a JSON or YAML file,
+    # into application (a new Application by default) and returns it. Services are numbered
+    # after those application already has. Raises ValueError listing every problem found in the
+    # schema before creating anything.
+    handlers = handlers or {}
+    if isinstance(schema, str):
+        schema = load_schema(schema)
+    errors = check_schema(schema, handlers)
+    if errors:
+        raise ValueError("invalid GATT schema:\n  " + "\n  ".join(errors))
+    if application is None:
+        application = Application(bus)
+    first = len(application.services)
+    in_use = set(service.path for service in application.services)
+    paths = [path_base + "/service" + str(i) for i in range(first, first + len(schema['services']))]
+    errors = ["%s: object path already in use" % path for path in paths if path in in_use]
+    if errors:
+        raise ValueError("invalid GATT schema:\n  " + "\n  ".join(errors))
+    services = []
+    for i, entry in enumerate(schema['services'], first):
+        service = SchemaService(bus, path_base, i, full_uuid(entry['uuid']), entry.get('primary', True))
+        for j, chrc_entry in enumerate(entry.get('characteristics', [])):
+            chrc = SchemaCharacteristic(
+                bus, j, full_uuid(chrc_entry['uuid']), list(chrc_entry.get('flags', [])), service,
+                attribute_handlers(chrc_entry, handlers),
+                fixed_value(chrc_entry['value']) if 'value' in chrc_entry else None)
+            for k, desc_entry in enumerate(chrc_entry.get('descriptors', [])):
+                chrc.add_descriptor(SchemaDescriptor(
+                    bus, k, full_uuid(desc_entry['uuid']), list(desc_entry.get('flags', [])), chrc,
+                    attribute_handlers(desc_entry, handlers),
+                    fixed_value(desc_entry['value']) if 'value' in desc_entry else None))
+            service.add_characteristic(chrc)
+        services.append(service)
+    # the tree is complete, so every property dict can be computed once
+    for service in services:
+        for attribute in walk(service):
+            attribute.freeze()
+        log.info("Adding service %s from schema", service.uuid)
+        application.add_service(service)
+    return application
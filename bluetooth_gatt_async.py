@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+#
+# asyncio version of bluetooth_gatt.py, built on dbus-next instead of dbus-python and GLib.
+#
+# Service, Characteristic, Descriptor and Application take the same arguments and are extended
+# the same way: override ReadValue(options), WriteValue(value, options), StartNotify() and
+# StopNotify(), which may be plain functions or coroutines, and send notifications with
+# PropertiesChanged(interface, {'Value': value}, []) or notify(value). Options arrive as a plain
+# dict with the variants unwrapped. Errors are raised with the exceptions below rather than
+# those in bluetooth_exceptions.py.
+#
+# Everything runs on one event loop, so the CAN buses can be read straight into the bridge with
+# can_reader.LoopReader, with no reader thread or FrameRing (see ble5_can0_async.py):
+#
+#   bus = await bluetooth_gatt_async.connect()
+#   application = MyApplication(bus)
+#   await bluetooth_gatt_async.register_application(bus, application)
+#   await bluetooth_gatt_async.register_advertisement(bus, MyAdvertisement(bus, 0, 'peripheral'))
+#   await asyncio.get_running_loop().create_future()
+
+import inspect
+from dbus_next import BusType, DBusError, PropertyAccess, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import ServiceInterface, dbus_property, method
+import bluetooth_constants
+import bluetooth_log
+
+log = bluetooth_log.get_logger('gatt')
+adv_log = bluetooth_log.get_logger('adv')
+
+
+# dbus-next 0.2 sends these back to the caller correctly but also reports them to the event
+# loop's exception handler, so expect them in the log.
+
+class BluezError(DBusError):
+    error_name = 'org.bluez.Error.Failed'
+
+    def __init__(self, text=None):
+        DBusError.__init__(self, self.error_name, text or self.error_name)
+
+class InvalidArgsException(BluezError):
+    error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+class NotSupportedException(BluezError):
+    error_name = 'org.bluez.Error.NotSupported'
+
+class NotPermittedException(BluezError):
+    error_name = 'org.bluez.Error.NotPermitted'
+
+class NotAuthorizedException(BluezError):
+    error_name = 'org.bluez.Error.NotAuthorized'
+
+class InvalidValueLengthException(BluezError):
+    error_name = 'org.bluez.Error.InvalidValueLength'
+
+class InvalidOffsetException(BluezError):
+    error_name = 'org.bluez.Error.InvalidOffset'
+
+class FailedException(BluezError):
+    error_name = 'org.bluez.Error.Failed'
+
+
+async def call(function, *args):
+    # calls an overridable handler which may or may not be a coroutine
+    result = function(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def unwrap(options):
+    return {key: value.value if isinstance(value, Variant) else value for key, value in options.items()}
+
+
+def walk(attribute):
+    # the attribute followed by everything below it, parents before their children
+    yield attribute
+    if isinstance(attribute, Service):
+        for chrc in attribute.characteristics:
+            yield from walk(chrc)
+    elif isinstance(attribute, Characteristic):
+        for desc in attribute.descriptors:
+            yield from walk(desc)
+
+
+async def connect():
+    return await MessageBus(bus_type=BusType.SYSTEM).connect()
+
+
+async def find_adapter(bus, interface=bluetooth_constants.GATT_MANAGER_INTERFACE):
+    # path of the first adapter with the given interface, ADAPTER_NAME if it has it
+    introspection = await bus.introspect(bluetooth_constants.BLUEZ_SERVICE_NAME, '/')
+    manager = bus.get_proxy_object(bluetooth_constants.BLUEZ_SERVICE_NAME, '/', introspection) \
+        .get_interface(bluetooth_constants.DBUS_OM_IFACE)
+    found = None
+    for path, interfaces in (await manager.call_get_managed_objects()).items():
+        if interface in interfaces:
+            if path.endswith('/' + bluetooth_constants.ADAPTER_NAME):
+                return path
+            found = found or path
+    if found is None:
+        raise RuntimeError("no Bluetooth adapter with %s" % interface)
+    return found
+
+
+async def get_interface(bus, path, interface):
+    introspection = await bus.introspect(bluetooth_constants.BLUEZ_SERVICE_NAME, path)
+    return bus.get_proxy_object(bluetooth_constants.BLUEZ_SERVICE_NAME, path, introspection).get_interface(interface)
+
+
+async def register_application(bus, application, adapter_path=None):
+    adapter_path = adapter_path or await find_adapter(bus)
+    gatt_manager = await get_interface(bus, adapter_path, bluetooth_constants.GATT_MANAGER_INTERFACE)
+    await gatt_manager.call_register_application(application.path, {})
+    log.info("Application registered")
+
+
+async def register_advertisement(bus, advertisement, adapter_path=None):
+    adapter_path = adapter_path or await find_adapter(bus, bluetooth_constants.ADVERTISING_MANAGER_INTERFACE)
+    adv_manager = await get_interface(bus, adapter_path, bluetooth_constants.ADVERTISING_MANAGER_INTERFACE)
+    await adv_manager.call_register_advertisement(advertisement.path, {})
+    adv_log.info("Advertisement registered")
+
+
+class Application:
+    """
+    The services of a GATT application. dbus-next itself answers GetManagedObjects for the
+    objects exported below path and sends InterfacesAdded and InterfacesRemoved as they are
+    exported and unexported, so attributes can be added and removed at any time.
+    """
+    def __init__(self, bus, path='/'):
+        self.path = path
+        self.bus = bus
+        self.services = []
+
+    def get_path(self):
+        return self.path
+
+    def add_service(self, service):
+        self.services.append(service)
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        for attribute in reversed(list(walk(service))):
+            self.bus.unexport(attribute.get_path(), attribute)
+
+
+class Service(ServiceInterface):
+    """
+    org.bluez.GattService1 interface implementation
+    """
+
+    def __init__(self, bus, path_base, index, uuid, primary):
+        ServiceInterface.__init__(self, bluetooth_constants.GATT_SERVICE_INTERFACE)
+        self.path = path_base + "/service" + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+        bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+
+    def get_characteristic_paths(self):
+        return [chrc.get_path() for chrc in self.characteristics]
+
+    def get_characteristics(self):
+        return self.characteristics
+
+    @dbus_property(PropertyAccess.READ, name='UUID')
+    def uuid_property(self) -> 's':
+        return self.uuid
+
+    @dbus_property(PropertyAccess.READ, name='Primary')
+    def primary_property(self) -> 'b':
+        return self.primary
+
+    @dbus_property(PropertyAccess.READ, name='Characteristics')
+    def characteristics_property(self) -> 'ao':
+        return self.get_characteristic_paths()
+
+
+class Characteristic(ServiceInterface):
+    """
+    org.bluez.GattCharacteristic1 interface implementation
+    """
+    def __init__(self, bus, index, uuid, flags, service):
+        ServiceInterface.__init__(self, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+        self.path = service.path + '/char' + str(index)
+        log.debug("creating Characteristic with path=%s", self.path)
+        self.bus = bus
+        self.uuid = uuid
+        self.service = service
+        self.flags = flags
+        self.descriptors = []
+        self.last_value = b''
+        bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    def add_descriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+
+    def get_descriptor_paths(self):
+        return [desc.get_path() for desc in self.descriptors]
+
+    def get_descriptors(self):
+        return self.descriptors
+
+    def ReadValue(self, options):
+        log.warning("Default ReadValue called, returning error")
+        raise NotSupportedException()
+
+    def WriteValue(self, value, options):
+        log.warning("Default WriteValue called, returning error")
+        raise NotSupportedException()
+
+    def StartNotify(self):
+        log.warning("Default StartNotify called, returning error")
+        raise NotSupportedException()
+
+    def StopNotify(self):
+        log.warning("Default StopNotify called, returning error")
+        raise NotSupportedException()
+
+    def PropertiesChanged(self, interface, changed, invalidated):
+        # same call as the dbus-python signal, only Value changes. dbus-next only takes bytes
+        # for 'ay', so a bytearray or memoryview value (e.g. from can_bridge.FrameBatcher) is copied.
+        if 'Value' in changed:
+            self.last_value = bytes(changed['Value'])
+            changed = dict(changed, Value=self.last_value)
+        self.emit_properties_changed(changed, invalidated)
+
+    def notify(self, value):
+        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, {'Value': value}, [])
+
+    @method(name='ReadValue')
+    async def read_value_method(self, options: 'a{sv}') -> 'ay':
+        return bytes(await call(self.ReadValue, unwrap(options)))
+
+    @method(name='WriteValue')
+    async def write_value_method(self, value: 'ay', options: 'a{sv}'):
+        await call(self.WriteValue, value, unwrap(options))
+
+    @method(name='StartNotify')
+    async def start_notify_method(self):
+        await call(self.StartNotify)
+
+    @method(name='StopNotify')
+    async def stop_notify_method(self):
+        await call(self.StopNotify)
+
+    @dbus_property(PropertyAccess.READ, name='Service')
+    def service_property(self) -> 'o':
+        return self.service.get_path()
+
+    @dbus_property(PropertyAccess.READ, name='UUID')
+    def uuid_property(self) -> 's':
+        return self.uuid
+
+    @dbus_property(PropertyAccess.READ, name='Flags')
+    def flags_property(self) -> 'as':
+        return self.flags
+
+    @dbus_property(PropertyAccess.READ, name='Descriptors')
+    def descriptors_property(self) -> 'ao':
+        return self.get_descriptor_paths()
+
+    @dbus_property(PropertyAccess.READ, name='Value')
+    def value_property(self) -> 'ay':
+        return self.last_value
+
+
+class Descriptor(ServiceInterface):
+    """
+    org.bluez.GattDescriptor1 interface implementation
+    """
+    def __init__(self, bus, index, uuid, flags, characteristic):
+        ServiceInterface.__init__(self, bluetooth_constants.GATT_DESCRIPTOR_INTERFACE)
+        self.path = characteristic.path + '/desc' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.flags = flags
+        self.chrc = characteristic
+        bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    def ReadValue(self, options):
+        log.warning("Default ReadValue called, returning error")
+        raise NotSupportedException()
+
+    def WriteValue(self, value, options):
+        log.warning("Default WriteValue called, returning error")
+        raise NotSupportedException()
+
+    @method(name='ReadValue')
+    async def read_value_method(self, options: 'a{sv}') -> 'ay':
+        return bytes(await call(self.ReadValue, unwrap(options)))
+
+    @method(name='WriteValue')
+    async def write_value_method(self, value: 'ay', options: 'a{sv}'):
+        await call(self.WriteValue, value, unwrap(options))
+
+    @dbus_property(PropertyAccess.READ, name='Characteristic')
+    def characteristic_property(self) -> 'o':
+        return self.chrc.get_path()
+
+    @dbus_property(PropertyAccess.READ, name='UUID')
+    def uuid_property(self) -> 's':
+        return self.uuid
+
+    @dbus_property(PropertyAccess.READ, name='Flags')
+    def flags_property(self) -> 'as':
+        return self.flags
+
+
+class Advertisement(ServiceInterface):
+    """
+    org.bluez.LEAdvertisement1 interface implementation with the properties the server
+    scripts use. Set the attributes before registering it.
+    """
+    PATH_BASE = '/org/bluez/ldsg/advertisement'
+
+    def __init__(self, bus, index, advertising_type):
+        ServiceInterface.__init__(self, bluetooth_constants.ADVERTISEMENT_INTERFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.ad_type = advertising_type
+        self.service_uuids = []
+        self.local_name = ''
+        self.include_tx_power = False
+        self.discoverable = True
+        bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    @method(name='Release')
+    def release(self):
+        adv_log.info("%s: Released", self.path)
+
+    @dbus_property(PropertyAccess.READ, name='Type')
+    def type_property(self) -> 's':
+        return self.ad_type
+
+    @dbus_property(PropertyAccess.READ, name='ServiceUUIDs')
+    def service_uuids_property(self) -> 'as':
+        return self.service_uuids
+
+    @dbus_property(PropertyAccess.READ, name='LocalName')
+    def local_name_property(self) -> 's':
+        return self.local_name
+
+    @dbus_property(PropertyAccess.READ, name='Discoverable')
+    def discoverable_property(self) -> 'b':
+        return self.discoverable
+
+    @dbus_property(PropertyAccess.READ, name='Includes')
+    def includes_property(self) -> 'as':
+        return ['tx-power'] if self.include_tx_power else []
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+#
+# Logging for the GATT server scripts.
+#
+# Loggers are grouped in categories (e.g. 'adv', 'gatt', 'can', 'can.frames') under the 'ble'
+# logger. Callers only put records on a queue; a background thread formats and writes them, so
+# a slow stdout or journald never holds up the main loop. Each message is rate limited: after
+# RATE_BURST records of the same message in RATE_INTERVAL seconds the rest are dropped and
+# counted, and the count is reported with the next one let through.
+#
+# Levels come from the BLE_LOG environment variable, a default level optionally followed by
+# category=level pairs:
+#
+#   BLE_LOG=INFO                    the default, per frame and per notification messages are off
+#   BLE_LOG=INFO,can.frames=DEBUG   print every CAN frame as well
+#   BLE_LOG=WARNING,adv=INFO
+#
+# Messages are formatted on the background thread from the logger's arguments, so use
+# log.debug("value %s", value) rather than an f-string, and don't change the arguments afterwards.
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+ROOT = 'ble'
+DEFAULT_LEVELS = 'INFO'
+FORMAT = '%(levelname)s %(name)s: %(message)s'
+RATE_BURST = 10
+RATE_INTERVAL = 1.0
+
+listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most burst records of each message (logger and format string) through per
+    interval seconds. The number dropped is attached to the next record let through.
+    """
+
+    def __init__(self, burst=RATE_BURST, interval=RATE_INTERVAL):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.windows = {}   # (logger name, msg) -> [window start, records let through, records dropped]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        window = self.windows.get(key)
+        if window is None or record.created - window[0] >= self.interval:
+            if window is not None and window[2]:
+                record.suppressed = window[2]
+            self.windows[key] = [record.created, 1, 0]
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves all formatting to the listener thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class Formatter(logging.Formatter):
+    def format(self, record):
+        message = logging.Formatter.format(self, record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += " (%d similar messages suppressed)" % suppressed
+        return message
+
+
+def parse_levels(spec):
+    # "INFO,can.frames=DEBUG" -> (INFO, {'can.frames': DEBUG})
+    default = INFO
+    levels = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        category, _, level = item.rpartition('=')
+        level = logging.getLevelName(level.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError("unknown log level in '%s'" % item)
+        if category:
+            levels[category.strip()] = level
+        else:
+            default = level
+    return default, levels
+
+
+def set_levels(spec):
+    default, levels = parse_levels(spec)
+    logging.getLogger(ROOT).setLevel(default)
+    for category, level in levels.items():
+        logging.getLogger(ROOT + '.' + category).setLevel(level)
+
+
+def setup(spec=None, stream=None):
+    # called by the first get_logger(), sets up the queue and its writer thread once
+    global listener
+    if listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(Formatter(FORMAT))
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(RateLimitFilter())
+    root = logging.getLogger(ROOT)
+    root.addHandler(handler)
+    root.propagate = False
+    try:
+        set_levels(spec if spec is not None else os.environ.get('BLE_LOG', DEFAULT_LEVELS))
+    except ValueError as e:
+        set_levels(DEFAULT_LEVELS)
+        root.warning("Ignoring BLE_LOG: %s", e)
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    # write out whatever is still queued when the script exits
+    atexit.register(listener.stop)
+
+
+def get_logger(category):
+    setup()
+    return logging.getLogger(ROOT + '.' + category)
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+#
+# Throughput and latency benchmark of the CAN to BLE bridge.
+#
+# Each capture in BRP/Logs is replayed (see can_replay.py) through the same pipeline as
+# ble5_can0.py: a reader thread queues frames in a FrameRing and the main loop drains them
+# into a CanBridge. BlueZ is replaced by a stub notify that copies each payload, like
+# dbus.ByteArray does, and records when it was sent. Frames are stamped with the time they
+# were queued so the latency of every notified frame can be read back from the compact format.
+# Legacy records carry no time, so for them the stamps are kept in the order the frames reach
+# the batcher and matched to the records in order.
+#
+# Results go to stdout or a file as JSON so they can be compared from commit to commit:
+#
+#   python3 can_benchmark.py -o bench.json
+#   python3 can_benchmark.py -s 1 "BRP/Logs/IBR Pull.log"      at the original pace
+
+import argparse
+import glob
+import json
+import os
+import platform
+import select
+import subprocess
+import threading
+import time
+import can_bridge
+import can_compress
+import can_replay
+import can_wire
+
+# the defaults of ble5_can0.py
+BATCH_MTU = 185
+BATCH_DELAY = 0.010
+QUEUE_SIZE = 4096
+QUEUE_OVERFLOW = can_bridge.DROP_OLDEST
+QUEUE_DRAIN_LIMIT = 512
+
+FORMATS = ['legacy', 'compact', 'deflate']
+LOGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BRP', 'Logs', '*.log')
+
+
+def make_batcher(name):
+    if name == 'deflate':
+        return can_compress.CompressedBatcher(BATCH_MTU, BATCH_DELAY, can_compress.load_dictionary())
+    return can_bridge.FrameBatcher(BATCH_MTU, BATCH_DELAY, can_wire.make_encoder(name))
+
+
+def percentile(values, p):
+    # values must be sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class TimedBridge(can_bridge.CanBridge):
+    """
+    CanBridge that remembers the timestamp of every frame handed to the batcher, in order.
+    """
+
+    def __init__(self, batcher, notify):
+        can_bridge.CanBridge.__init__(self, batcher, notify)
+        self.added = []
+
+    def send(self, frame, now):
+        self.added.append(frame[2])
+        can_bridge.CanBridge.send(self, frame, now)
+
+
+def run(frames, name, speed=0):
+    # Replays frames through the bridge with the given batcher and returns the result dict
+    clock = time.perf_counter
+    sent = []
+    batcher = make_batcher(name)
+    bridge = TimedBridge(batcher, lambda payload: sent.append((clock(), bytes(payload))))
+    ring = can_bridge.FrameRing(QUEUE_SIZE, QUEUE_OVERFLOW)
+
+    def queue_frame(can_id, data, timestamp):
+        # what listen_to_can does with a message, stamped with the time it was received.
+        # Flat out, the reader waits for room so the result is the rate the bridge sustains
+        # without dropping; at a real pace a full ring drops frames as it would on the bus.
+        while not speed and len(ring) >= QUEUE_SIZE:
+            time.sleep(0.0001)
+        ring.put((can_id, data, clock()))
+
+    replayer = can_replay.Replayer(frames, queue_frame, speed)
+    reader = threading.Thread(target=replayer.run)
+    # CPU time of this thread only, the bridge's work without the replay thread's
+    cpu_started = time.thread_time()
+    started = clock()
+    reader.start()
+    while reader.is_alive() or len(ring):
+        now = clock()
+        time_left = bridge.time_left(now)
+        timeout = 0.05 if time_left is None else min(time_left, 0.05)
+        if select.select([ring], [], [], timeout)[0] or len(ring):
+            now = clock()
+            bridge.process(ring.drain(QUEUE_DRAIN_LIMIT), now)
+        else:
+            bridge.poll(clock())
+    reader.join()
+    # whatever is left is sent at the end of the capture
+    payload = batcher.flush()
+    while payload is not None:
+        bridge.deliver(payload)
+        payload = batcher.flush()
+    elapsed = clock() - started
+    cpu = time.thread_time() - cpu_started
+    ring.close()
+
+    notified = 0
+    payload_bytes = 0
+    latencies = []
+    zdict = batcher.compressor.zdict if name == 'deflate' else None
+    for sent_at, payload in sent:
+        payload_bytes += len(payload)
+        sent_us = int(sent_at * 1000000)
+        for timestamp_us, can_id, data in can_compress.decode(payload, zdict):
+            if timestamp_us is None:
+                timestamp_us = int(bridge.added[notified] * 1000000)
+            notified += 1
+            latencies.append(((sent_us - timestamp_us) & 0xFFFFFFFF) / 1000.0)
+    latencies.sort()
+    queued = len(frames)
+    return {
+        'format': name,
+        'speed': speed,
+        'frames': queued,
+        'notifications': len(sent),
+        'frames_notified': notified,
+        'dropped': ring.dropped,
+        'lost': queued - notified,
+        'seconds': round(elapsed, 6),
+        'frames_per_s': round(notified / elapsed, 1),
+        'bytes_per_s': round(payload_bytes / elapsed, 1),
+        'frames_per_notification': round(notified / len(sent), 2) if sent else 0,
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'p999': percentile(latencies, 99.9),
+            'max': latencies[-1] if latencies else None,
+        },
+        'cpu_us_per_frame': round(cpu / queued * 1e6, 3) if queued else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the CAN to BLE bridge with the BRP captures")
+    parser.add_argument('logs', nargs='*', help="candump logs or CSV exports (default BRP/Logs/*.log)")
+    parser.add_argument('-f', '--format', action='append', choices=FORMATS, help="notification format, repeatable (default all)")
+    parser.add_argument('-s', '--speed', type=float, default=0, help="replay speed, 0 is as fast as possible (default)")
+    parser.add_argument('-o', '--output', help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for log in args.logs or sorted(glob.glob(LOGS)):
+        # parsed up front so the benchmark measures the bridge, not the log parser
+        frames = list(can_replay.read_frames(log))
+        for name in args.format or FORMATS:
+            result = run(frames, name, args.speed)
+            result['log'] = os.path.basename(log)
+            results.append(result)
+            print("%s %s: %.0f frames/s, %.0f bytes/s, p99 %s ms, %s dropped, %s lost, %.2f us CPU per frame" % (
+                result['log'], name, result['frames_per_s'], result['bytes_per_s'],
+                result['latency_ms']['p99'], result['dropped'], result['lost'], result['cpu_us_per_frame']))
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'batch_mtu': BATCH_MTU,
+        'batch_delay': BATCH_DELAY,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
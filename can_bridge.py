@@ -0,0 +1,640 @@
+#!/usr/bin/python3
+#
+# Building blocks for bridging frames read from a SocketCAN bus onto a GATT characteristic.
+#
+# Nothing in here imports dbus or python-can so the pieces can be exercised away from the
+# Raspberry Pi. The server scripts (e.g. ble5_can0.py) wrap the results in dbus types.
+
+import array
+import collections
+import itertools
+import os
+import struct
+import can_wire
+
+ATT_HEADER_SIZE = 3     # opcode + attribute handle carried by every ATT notification
+ATT_MIN_MTU = 23        # every BLE link supports at least this, the MTU before any exchange
+BATCH_BUFFERS = 4       # payload buffers rotated by FrameBatcher
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+CAN_EFF_FLAG = can_wire.CAN_EFF_FLAG   # set in a filter id to match extended (29 bit) frames
+CAN_SFF_MASK = can_wire.CAN_SFF_MASK
+CAN_EFF_MASK = can_wire.CAN_EFF_MASK
+
+# first byte of a value written to the CAN control characteristic
+CONTROL_SET_FILTERS = 0x01
+CONTROL_SET_CHANGE_ONLY = 0x02
+CONTROL_BACKFILL = 0x03
+
+ATT_MAX_VALUE = 512         # longest attribute value ATT allows
+SNAPSHOT_MAX = ATT_MAX_VALUE    # read in parts with offsets
+SNAPSHOT_TRUNCATED = 0x02   # compact header flag, the ids updated longest ago were left out
+
+FILTER = struct.Struct('>II')           # id, mask
+KEEPALIVE = struct.Struct('>H')         # default keep-alive in ms, 0 turns change-only mode off
+ID_KEEPALIVE = struct.Struct('>IH')     # id, keep-alive in ms
+BACKFILL = struct.Struct('>H')          # seconds of history wanted, 0 for all of it
+BACKFILL_CHUNK = 64     # history frames packed between checks that the phone keeps up
+BACKFILL_HOLD = 4096    # live frames kept back while a backfill is sent, newer ones are dropped
+
+
+def decode_filters(value):
+    # Parses the body of a CONTROL_SET_FILTERS write into python-can filter dicts.
+    # The body is a list of 8 byte (id, mask) pairs, big endian. CAN_EFF_FLAG in the id
+    # selects extended frames. An empty list removes all filters so every frame is received.
+    if len(value) % FILTER.size != 0:
+        raise ValueError("filter list must be a multiple of %d bytes" % FILTER.size)
+    filters = []
+    for can_id, can_mask in FILTER.iter_unpack(value):
+        extended = bool(can_id & CAN_EFF_FLAG)
+        id_mask = CAN_EFF_MASK if extended else CAN_SFF_MASK
+        filters.append({'can_id': can_id & id_mask, 'can_mask': can_mask & id_mask, 'extended': extended})
+    return filters
+
+
+def encode_filters(filters):
+    value = bytearray()
+    for f in filters:
+        can_id = f['can_id'] | (CAN_EFF_FLAG if f.get('extended') else 0)
+        value += FILTER.pack(can_id, f['can_mask'])
+    return bytes(value)
+
+
+def decode_change_only(value):
+    # Parses the body of a CONTROL_SET_CHANGE_ONLY write into (keepalive, {can_id: keepalive}),
+    # both in seconds. The body is the default keep-alive followed by optional per id overrides.
+    if len(value) < KEEPALIVE.size or (len(value) - KEEPALIVE.size) % ID_KEEPALIVE.size != 0:
+        raise ValueError("expected a %d byte keep-alive and %d byte per id entries" % (KEEPALIVE.size, ID_KEEPALIVE.size))
+    keepalive = KEEPALIVE.unpack_from(value)[0] / 1000.0
+    overrides = {}
+    for can_id, ms in ID_KEEPALIVE.iter_unpack(value[KEEPALIVE.size:]):
+        # ids keep CAN_EFF_FLAG so they match frames as queued by the reader
+        overrides[can_id] = ms / 1000.0
+    return keepalive, overrides
+
+
+def decode_backfill(value):
+    # Parses the body of a CONTROL_BACKFILL write into the seconds of history wanted, None for all
+    if len(value) == 0:
+        return None
+    if len(value) != BACKFILL.size:
+        raise ValueError("expected a %d byte number of seconds" % BACKFILL.size)
+    return BACKFILL.unpack(value)[0] or None
+
+
+class ChangeFilter:
+    """
+    Forwards a frame only when its data differs from the last one forwarded with the same id.
+
+    Most ids on the bus repeat the same payload every cycle. An unchanged frame is still let
+    through once keepalive seconds have passed since its id was last forwarded, so the phone's
+    view never goes stale. Keep-alive intervals can be overridden per id.
+
+    accept() only decides, forwarded() records a frame once it has really been sent, so a
+    frame the scheduler throws away afterwards does not suppress the ones after it.
+    """
+
+    def __init__(self, keepalive, overrides=None):
+        self.keepalive = keepalive
+        self.overrides = overrides or {}
+        self.last = {}      # can_id -> (data, time last forwarded)
+        self.suppressed = 0
+
+    def accept(self, can_id, data, now):
+        last = self.last.get(can_id)
+        if last is not None and last[0] == data and now - last[1] < self.overrides.get(can_id, self.keepalive):
+            self.suppressed += 1
+            return False
+        return True
+
+    def forwarded(self, can_id, data, now):
+        self.last[can_id] = (bytes(data), now)
+
+    def reset(self):
+        # forget what was sent so the next frame of every id goes through
+        self.last.clear()
+
+
+class FairScheduler:
+    """
+    Decides which frames get onto the BLE link and in which order.
+
+    Each id can be limited to max_rate frames per second and/or decimated so that only every
+    decimation'th frame is kept. Frames that pass wait in a short queue per id and are handed
+    out round robin, one frame per id per turn, so a flood of one id queues behind itself
+    instead of starving rare ids. When link_rate is set no more than that many frames per
+    second are handed out and the rest wait, keeping only the newest depth frames per id.
+    """
+
+    def __init__(self, max_rate=None, decimation=1, link_rate=None, depth=4):
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.interval_overrides = {}    # can_id -> min seconds between frames
+        self.decimation = decimation
+        self.link_rate = link_rate
+        self.depth = depth
+        self.seen = {}                  # can_id -> frames seen, for decimation
+        self.next_allowed = {}          # can_id -> earliest time the next frame may pass
+        self.queues = {}                # can_id -> deque of frames waiting for the link
+        self.active = collections.deque()   # ids with queued frames in round robin order
+        self.tokens = float(link_rate or 0)
+        self.refilled = None
+        self.decimated = 0
+        self.rate_limited = 0
+        self.dropped = 0
+
+    def set_max_rate(self, can_id, max_rate):
+        self.interval_overrides[can_id] = 1.0 / max_rate if max_rate else 0.0
+
+    def __len__(self):
+        return len(self.active)
+
+    def push(self, frame, now):
+        can_id = frame[0]
+        if self.decimation > 1:
+            seen = self.seen.get(can_id, 0)
+            self.seen[can_id] = seen + 1
+            if seen % self.decimation:
+                self.decimated += 1
+                return
+        interval = self.interval_overrides.get(can_id, self.min_interval)
+        if interval:
+            if now < self.next_allowed.get(can_id, 0.0):
+                self.rate_limited += 1
+                return
+            self.next_allowed[can_id] = now + interval
+        queue = self.queues.get(can_id)
+        if queue is None:
+            queue = self.queues[can_id] = collections.deque(maxlen=self.depth)
+        if not queue:
+            self.active.append(can_id)
+        elif len(queue) == self.depth:
+            self.dropped += 1
+        queue.append(frame)
+
+    def pop(self, now):
+        # returns the frames the link has room for, interleaved round robin across ids
+        budget = len(self.active) * self.depth
+        if self.link_rate:
+            if self.refilled is not None:
+                # allow at most one second worth of burst
+                self.tokens = min(self.link_rate, self.tokens + (now - self.refilled) * self.link_rate)
+            self.refilled = now
+            budget = min(budget, int(self.tokens))
+        frames = []
+        active = self.active
+        while active and len(frames) < budget:
+            can_id = active.popleft()
+            queue = self.queues[can_id]
+            frames.append(queue.popleft())
+            if queue:
+                active.append(can_id)
+        if self.link_rate:
+            self.tokens -= len(frames)
+        return frames
+
+    def clear(self):
+        self.queues.clear()
+        self.active.clear()
+
+    def time_left(self, now):
+        # seconds until pop() can hand out another frame, or None when nothing is waiting
+        if not self.active:
+            return None
+        if not self.link_rate or self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.link_rate
+
+
+class FrameBatcher:
+    """
+    Packs CAN frames into notification payloads that fit in a single ATT packet.
+
+    A batch is flushed as soon as the next frame does not fit or once its oldest frame has
+    been waiting for max_delay seconds, whichever comes first. The encoder decides the wire
+    format, see can_wire.
+
+    Frames are packed straight into preallocated buffers, so adding a frame allocates
+    nothing. flush() returns a memoryview of the filled part of the current buffer; it stays
+    valid until BATCH_BUFFERS more batches have been flushed, which gives the caller plenty
+    of time to hand it to dbus.
+    """
+
+    def __init__(self, mtu, max_delay, encoder=None):
+        self.max_delay = max_delay
+        self.encoder = encoder if encoder is not None else can_wire.RecordEncoder()
+        self.offset = 0
+        self.deadline = None
+        self.set_mtu(mtu)
+
+    def set_mtu(self, mtu):
+        # drops whatever is pending, see CanBridge.set_mtu
+        self.size = self.encoder.payload_size(min(max(mtu, ATT_MIN_MTU) - ATT_HEADER_SIZE, ATT_MAX_VALUE))
+        self.buffers = [bytearray(self.size) for _ in range(BATCH_BUFFERS)]
+        self.current = 0
+        self.view = memoryview(self.buffers[0])
+        self.offset = 0
+        self.deadline = None
+
+    def add(self, can_id, data, timestamp, now):
+        # returns a payload to send when the frame completes a batch, otherwise None
+        payload = None
+        if self.offset == 0:
+            self.start(timestamp, now)
+        end = self.encoder.pack_into(self.view, self.offset, can_id, data, timestamp)
+        if end < 0:
+            # no room left, send what we have and start the next batch with this frame
+            payload = self.flush()
+            self.start(timestamp, now)
+            end = self.encoder.pack_into(self.view, self.offset, can_id, data, timestamp)
+        self.offset = end
+        if payload is None and end >= self.size:
+            payload = self.flush()
+        return payload
+
+    def start(self, timestamp, now):
+        self.deadline = now + self.max_delay
+        self.offset = self.encoder.begin(self.view, timestamp)
+
+    def poll(self, now):
+        # returns the pending payload once its deadline has passed, otherwise None
+        if self.offset and now >= self.deadline:
+            return self.flush()
+        return None
+
+    def time_left(self, now):
+        # seconds until the pending batch is due, or None when there is nothing pending
+        if not self.offset:
+            return None
+        return max(0.0, self.deadline - now)
+
+    def flush(self):
+        if not self.offset:
+            return None
+        payload = self.view[:self.offset]
+        self.current = (self.current + 1) % BATCH_BUFFERS
+        self.view = memoryview(self.buffers[self.current])
+        self.offset = 0
+        self.deadline = None
+        return payload
+
+
+class SnapshotTable:
+    """
+    The latest frame of every id seen on the bus.
+
+    Standard ids index a preallocated list of 2048 slots, so an update is a single store.
+    Extended ids go in a dict. encode() packs the table into one compact format payload (see
+    can_wire) with the frames in time order. If the table does not fit in limit bytes, the ids
+    updated longest ago are left out and the header flags carry SNAPSHOT_TRUNCATED.
+    """
+
+    def __init__(self):
+        self.standard = [None] * (CAN_SFF_MASK + 1)
+        self.extended = {}
+
+    def update(self, frames):
+        standard = self.standard
+        extended = self.extended
+        for frame in frames:
+            can_id = frame[0]
+            if can_id & CAN_EFF_FLAG:
+                extended[can_id] = frame
+            else:
+                standard[can_id] = frame
+
+    def clear(self):
+        self.standard = [None] * (CAN_SFF_MASK + 1)
+        self.extended.clear()
+
+    def frames(self):
+        frames = [frame for frame in self.standard if frame is not None]
+        frames.extend(self.extended.values())
+        frames.sort(key=lambda frame: frame[2])
+        return frames
+
+    def encode(self, limit=SNAPSHOT_MAX):
+        frames = self.frames()
+        if not frames:
+            return b''
+        us = [int(frame[2] * 1000000) for frame in frames]
+        # Leaving older frames out in front only changes the size of the new first record,
+        # whose delta from the header becomes 0, so the size for each starting point is that
+        # record plus the ones after it.
+        after = [0] * len(frames)
+        for i in range(len(frames) - 2, -1, -1):
+            frame = frames[i + 1]
+            after[i] = after[i + 1] + can_wire.compact_record_size(frame[0], len(frame[1]), us[i + 1] - us[i])
+        first = 0
+        for i in range(1, len(frames)):
+            if us[i] - us[i - 1] > can_wire.MAX_DELTA_US:
+                first = i
+        while first < len(frames) - 1 and can_wire.COMPACT_HEADER.size + after[first] + \
+                can_wire.compact_record_size(frames[first][0], len(frames[first][1]), 0) > limit:
+            first += 1
+        encoder = can_wire.CompactEncoder()
+        encoder.flags = SNAPSHOT_TRUNCATED if first else 0
+        buf = bytearray(can_wire.COMPACT_HEADER.size + can_wire.MAX_COMPACT_RECORD_SIZE + after[first])
+        offset = encoder.begin(buf, frames[first][2])
+        for can_id, data, timestamp in frames[first:]:
+            offset = encoder.pack_into(buf, offset, can_id, data, timestamp)
+        return bytes(buf[:offset])
+
+
+class HistoryRing:
+    """
+    The most recent frames, at most capacity of them and no older than max_age seconds before
+    the newest, for sending to a phone that has just subscribed.
+
+    Ids, timestamps, lengths and data live in arrays allocated up front, so the memory used is
+    fixed and recording a frame allocates nothing. The ring is written and read on the main loop.
+    """
+
+    def __init__(self, capacity, max_age=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.ids = array.array('I', bytes(4 * capacity))
+        self.timestamps = array.array('d', bytes(8 * capacity))
+        self.lengths = bytearray(capacity)
+        self.data = bytearray(8 * capacity)
+        self.next = 0       # slot written next
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, frames):
+        ids = self.ids
+        timestamps = self.timestamps
+        lengths = self.lengths
+        store = self.data
+        capacity = self.capacity
+        i = self.next
+        for can_id, data, timestamp in frames:
+            ids[i] = can_id
+            timestamps[i] = timestamp
+            length = len(data)
+            lengths[i] = length
+            store[8 * i:8 * i + length] = data
+            i += 1
+            if i == capacity:
+                i = 0
+        self.next = i
+        self.count = min(self.count + len(frames), capacity)
+
+    def clear(self):
+        self.next = 0
+        self.count = 0
+
+    def frames(self, seconds=None):
+        # yields (can_id, data, timestamp) oldest first, for the last seconds before the newest
+        # frame (or as much as is kept). The ring must not change while this is being read.
+        if not self.count:
+            return
+        capacity = self.capacity
+        newest = self.timestamps[(self.next - 1) % capacity]
+        ages = [a for a in (seconds, self.max_age) if a]
+        cutoff = newest - min(ages) if ages else None
+        i = (self.next - self.count) % capacity
+        for _ in range(self.count):
+            timestamp = self.timestamps[i]
+            if cutoff is None or timestamp >= cutoff:
+                yield self.ids[i], bytes(self.data[8 * i:8 * i + self.lengths[i]]), timestamp
+            i += 1
+            if i == capacity:
+                i = 0
+
+
+class FrameRing:
+    """
+    Bounded queue handing frames from the CAN reader thread to the GLib main loop.
+
+    There is exactly one producer (the reader thread) and one consumer (the main loop), and
+    deque append/popleft are atomic, so no lock is taken on either side. A full ring never
+    blocks the producer: depending on overflow either the oldest queued frame or the new
+    frame is discarded and counted in dropped.
+
+    The consumer is woken through a pipe so it can be attached to the main loop as an fd
+    watch. Only one wakeup byte is outstanding at a time, so a burst costs a single write.
+    """
+
+    def __init__(self, capacity, overflow=DROP_OLDEST):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("overflow must be '%s' or '%s'" % (DROP_OLDEST, DROP_NEWEST))
+        self.capacity = capacity
+        self.overflow = overflow
+        # with maxlen set the deque itself discards the oldest frame on overflow
+        self.frames = collections.deque(maxlen=capacity if overflow == DROP_OLDEST else None)
+        self.received = 0
+        self.dropped = 0
+        self.wakeup_pending = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+
+    def fileno(self):
+        return self.wakeup_r
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        # producer side, returns False if the frame was dropped
+        self.received += 1
+        if len(self.frames) >= self.capacity:
+            self.dropped += 1
+            if self.overflow == DROP_NEWEST:
+                return False
+        self.frames.append(frame)
+        if not self.wakeup_pending:
+            self.wakeup()
+        return True
+
+    def extend(self, frames):
+        # producer side, put() for a list of frames with a single wakeup
+        count = len(frames)
+        self.received += count
+        room = max(0, self.capacity - len(self.frames))
+        if count > room:
+            self.dropped += count - room
+            if self.overflow == DROP_NEWEST:
+                frames = frames[:room]
+        self.frames.extend(frames)
+        if frames and not self.wakeup_pending:
+            self.wakeup()
+
+    def wakeup(self):
+        self.wakeup_pending = True
+        try:
+            os.write(self.wakeup_w, b'\x01')
+        except BlockingIOError:
+            pass
+
+    def drain(self, limit):
+        # consumer side, returns up to limit frames in arrival order.
+        # The wakeup is acknowledged before reading so a put() racing with us re-arms it.
+        try:
+            os.read(self.wakeup_r, 64)
+        except BlockingIOError:
+            pass
+        self.wakeup_pending = False
+        frames = self.frames
+        count = min(limit, len(frames))
+        batch = [frames.popleft() for _ in range(count)]
+        if frames and not self.wakeup_pending:
+            # more than limit queued, come back on the next main loop iteration
+            self.wakeup()
+        return batch
+
+    def close(self):
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+
+class CanBridge:
+    """
+    Main loop side of the CAN to BLE pipeline.
+
+    Frames are (can_id, data, timestamp) tuples. can_id has CAN_EFF_FLAG set for extended
+    frames and timestamp is the receive time in seconds.
+
+    Frames drained from the FrameRing pass through the optional change filter and scheduler
+    and are packed by the batcher. notify is called with each payload as soon as it is ready;
+    the payload is only valid until the batcher has flushed a few more, see FrameBatcher.
+    notify returns False when it had to drop the payload. The frames, notifications and bytes
+    handed on and what was dropped are counted for can_stats.
+
+    A backfill is paced by ready, when set: a callable telling whether notify can take more
+    right now. Once it says no, the rest of the backfill waits for resume().
+    """
+
+    def __init__(self, batcher, notify, change_filter=None, scheduler=None):
+        self.batcher = batcher
+        self.notify = notify
+        self.change_filter = change_filter
+        self.scheduler = scheduler
+        self.batching = True
+        self.ready = None
+        self.backfilling = None     # iterator over the history still to send
+        self.held = collections.deque()     # live frames waiting for the backfill
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.notifications = 0
+        self.notifications_dropped = 0
+        self.bytes_sent = 0
+
+    def process(self, frames, now):
+        if self.backfilling is not None:
+            self.hold(frames)
+            return
+        change_filter = self.change_filter
+        scheduler = self.scheduler
+        for frame in frames:
+            if change_filter is not None and not change_filter.accept(frame[0], frame[1], now):
+                continue
+            if scheduler is not None:
+                scheduler.push(frame, now)
+            else:
+                self.send(frame, now)
+        self.poll(now)
+
+    def poll(self, now):
+        # hands out frames the scheduler was holding back and flushes a batch that is due
+        if self.scheduler is not None:
+            for frame in self.scheduler.pop(now):
+                self.send(frame, now)
+        payload = self.batcher.poll(now)
+        while payload is not None:
+            self.deliver(payload)
+            payload = self.batcher.poll(now)
+
+    def send(self, frame, now):
+        self.frames_sent += 1
+        if self.change_filter is not None:
+            self.change_filter.forwarded(frame[0], frame[1], now)
+        payload = self.batcher.add(frame[0], frame[1], frame[2], now)
+        if payload is None and not self.batching:
+            payload = self.batcher.flush()
+        if payload is not None:
+            self.deliver(payload)
+
+    def deliver(self, payload):
+        if self.notify(payload) is False:
+            self.notifications_dropped += 1
+            return
+        self.notifications += 1
+        self.bytes_sent += len(payload)
+
+    def backfill(self, frames, now):
+        # Sends frames, e.g. history for a phone that has just subscribed, ahead of any live
+        # traffic. Whatever was pending is dropped first: the history already holds it.
+        self.reset()
+        # copied, the source (e.g. a HistoryRing) may change before the backfill is out
+        self.backfilling = iter(list(frames))
+        self.resume(now)
+
+    def resume(self, now):
+        # carries on with a backfill, call when ready() may have changed
+        batcher = self.batcher
+        ready = self.ready
+        while self.backfilling is not None:
+            if ready is not None and not ready():
+                return
+            count = 0
+            for can_id, data, timestamp in itertools.islice(self.backfilling, BACKFILL_CHUNK):
+                count += 1
+                payload = batcher.add(can_id, data, timestamp, now)
+                if payload is not None:
+                    self.deliver(payload)
+            if count < BACKFILL_CHUNK:
+                self.backfilling = None
+                self.flush()
+        if self.held:
+            held = list(self.held)
+            self.held.clear()
+            self.process(held, now)
+
+    def hold(self, frames):
+        # keeps live frames back until the backfill is out
+        room = BACKFILL_HOLD - len(self.held)
+        if len(frames) > room:
+            self.frames_dropped += len(frames) - room
+            frames = frames[:room]
+        self.held.extend(frames)
+
+    def flush(self):
+        # sends whatever the batcher holds now
+        payload = self.batcher.flush()
+        while payload is not None:
+            self.deliver(payload)
+            payload = self.batcher.flush()
+
+    def set_batcher(self, batcher):
+        # sends whatever the old batcher still holds before switching, e.g. to another wire format
+        self.flush()
+        self.batcher = batcher
+
+    def set_mtu(self, mtu):
+        # sends what is pending at the old size and sizes notifications for the new ATT MTU
+        self.flush()
+        self.batcher.set_mtu(mtu)
+
+    def time_left(self, now):
+        # seconds until poll() has work to do, or None when nothing is pending
+        times = [self.batcher.time_left(now)]
+        if self.scheduler is not None:
+            times.append(self.scheduler.time_left(now))
+        times = [t for t in times if t is not None]
+        return min(times) if times else None
+
+    def reset(self):
+        # drops anything pending, e.g. when the phone stops notifications
+        while self.batcher.flush() is not None:
+            pass
+        self.backfilling = None
+        self.held.clear()
+        if self.scheduler is not None:
+            self.scheduler.clear()
+        if self.change_filter is not None:
+            self.change_filter.reset()
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+#
+# Optional compression of batched CAN notifications.
+#
+# A compressed notification is a compact format payload (see can_wire.py) with FLAG_DEFLATE
+# set in the header flags. The header stays as it is and the records after it are raw deflate
+# (zlib wbits -15) using a preset dictionary, so each notification can be inflated on its own.
+#
+# The dictionary is trained from captures of the bus: the most common id and data combinations
+# end up in it, so a frame that repeats a known payload costs a couple of bytes. Phone and
+# bridge must use the same dictionary, identified by its CRC-32. To rebuild it:
+#
+#   python3 can_compress.py can_zdict.bin BRP/Logs/*.log
+
+import collections
+import os
+import struct
+import sys
+import zlib
+import can_bridge
+import can_wire
+
+FLAG_DEFLATE = 0x01
+
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'can_zdict.bin')
+DICTIONARY_SIZE = 4096
+RAW_RATIO = 4       # raw bytes buffered per byte of notification payload
+SLACK = 8           # worst case growth of deflate output when records are appended
+
+# The capability characteristic value is a capability bit mask followed by the CRC-32 of the
+# dictionary. The bridge reads back what it supports, the phone writes what it supports.
+CAPABILITIES = struct.Struct('>BI')
+CAP_COMPACT = 0x01
+CAP_DEFLATE = 0x02
+
+
+def load_dictionary(path=DICTIONARY_PATH):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def dictionary_id(zdict):
+    return zlib.crc32(zdict)
+
+
+def decode_capabilities(value):
+    # returns (capabilities, dictionary id), the dictionary id is optional and defaults to 0
+    if len(value) == 1:
+        return value[0], 0
+    if len(value) != CAPABILITIES.size:
+        raise ValueError("expected 1 or %d bytes" % CAPABILITIES.size)
+    return CAPABILITIES.unpack(value)
+
+
+def build_dictionary(paths, size=DICTIONARY_SIZE):
+    # Counts the id/length word and data of every frame in the candump logs and keeps the most
+    # common ones. deflate finds matches closer to the data more cheaply, so the most common
+    # records go at the end.
+    counts = collections.Counter()
+    encoder = can_wire.CompactEncoder()
+    buf = bytearray(can_wire.COMPACT_HEADER.size + can_wire.MAX_COMPACT_RECORD_SIZE)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3 or '#' not in fields[2]:
+                    continue
+                can_id, data = fields[2].split('#')
+                frame_id = int(can_id, 16) | (can_wire.CAN_EFF_FLAG if len(can_id) > 3 else 0)
+                start = encoder.begin(buf, 0.0)
+                end = encoder.pack_into(buf, start, frame_id, bytes.fromhex(data), 0.0)
+                # skip the 1 byte zero delta, it varies in a live stream
+                counts[bytes(buf[start + 1:end])] += 1
+    records = []
+    total = 0
+    for record, count in counts.most_common():
+        if total + len(record) > size:
+            break
+        records.append(record)
+        total += len(record)
+    return b''.join(reversed(records))
+
+
+class BatchCompressor:
+    """
+    Raw deflate with a preset dictionary, one independent stream per notification.
+    """
+
+    def __init__(self, zdict, level=6):
+        self.zdict = zdict
+        self.level = level
+
+    def compress(self, data):
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, self.zdict)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data):
+        d = zlib.decompressobj(-15, self.zdict)
+        return d.decompress(data) + d.flush()
+
+
+class CompressedBatcher(can_bridge.FrameBatcher):
+    """
+    FrameBatcher that deflates each batch so more frames fit in a notification.
+
+    Records are buffered uncompressed, up to RAW_RATIO times the notification size. Once they
+    no longer fit as they are, the batch is trial compressed as records are added, skipping
+    trials that cannot overflow yet. When the compressed size goes past the limit, the longest
+    prefix known to fit is sent and the records after it start the next batch. A batch that
+    deflate cannot shrink is sent uncompressed.
+
+    Occasionally two payloads complete at once; the second waits in ready and time_left()
+    returns 0 so the caller polls for it straight away.
+    """
+
+    def __init__(self, mtu, max_delay, zdict, level=6):
+        self.compressor = BatchCompressor(zdict, level)
+        self.ready = collections.deque()
+        can_bridge.FrameBatcher.__init__(self, mtu, max_delay, can_wire.CompactEncoder())
+
+    def set_mtu(self, mtu):
+        can_bridge.FrameBatcher.set_mtu(self, mtu)
+        # the buffers hold raw records, the notification limit applies after compression
+        self.limit = self.size
+        self.size = self.limit * RAW_RATIO
+        self.buffers = [bytearray(self.size) for _ in range(can_bridge.BATCH_BUFFERS)]
+        self.view = memoryview(self.buffers[self.current])
+        self.mark_good(None)
+
+    def mark_good(self, compressed):
+        # good_end is the end of the longest prefix of the batch known to fit in a notification,
+        # good_base the time of its last record and good_payload its compressed form, if needed
+        self.good_end = self.offset
+        self.good_base = self.encoder.last_us
+        self.good_payload = compressed
+
+    def add(self, can_id, data, timestamp, now):
+        self.append(can_id, data, timestamp, now)
+        return self.ready.popleft() if self.ready else None
+
+    def append(self, can_id, data, timestamp, now):
+        if self.offset == 0:
+            self.start(timestamp, now)
+        end = self.encoder.pack_into(self.view, self.offset, can_id, data, timestamp)
+        while end < 0:
+            # out of raw space, or the frame needs a new time base
+            self.complete()
+            if self.offset == 0:
+                self.start(timestamp, now)
+            end = self.encoder.pack_into(self.view, self.offset, can_id, data, timestamp)
+        self.offset = end
+        if end <= self.limit:
+            self.mark_good(None)
+            return
+        if self.good_payload is not None and len(self.good_payload) + (end - self.good_end) + SLACK <= self.limit:
+            return
+        compressed = self.compress(end)
+        if len(compressed) <= self.limit:
+            self.mark_good(compressed)
+        else:
+            self.complete()
+
+    def start(self, timestamp, now):
+        can_bridge.FrameBatcher.start(self, timestamp, now)
+        self.mark_good(None)
+
+    def compress(self, end):
+        header_size = can_wire.COMPACT_HEADER.size
+        compressed = self.compressor.compress(self.view[header_size:end])
+        payload = bytearray(header_size + len(compressed))
+        payload[:header_size] = self.view[:header_size]
+        payload[0] |= FLAG_DEFLATE
+        payload[header_size:] = compressed
+        return payload
+
+    def complete(self):
+        # queues the longest prefix of the batch known to fit, records after it are added again
+        if self.offset > self.good_end:
+            compressed = self.compress(self.offset)
+            if len(compressed) <= self.limit:
+                self.mark_good(compressed)
+        end = self.good_end
+        payload = self.good_payload
+        if payload is None:
+            compressed = self.compress(end)
+            payload = compressed if len(compressed) < end else bytes(self.view[:end])
+        remainder = bytes(self.view[end:self.offset])
+        base = self.good_base
+        deadline = self.deadline
+        self.ready.append(payload)
+        self.current = (self.current + 1) % can_bridge.BATCH_BUFFERS
+        self.view = memoryview(self.buffers[self.current])
+        self.offset = 0
+        self.deadline = None
+        if remainder:
+            header = can_wire.COMPACT_HEADER.pack(can_wire.COMPACT_VERSION << 4, base & 0xFFFFFFFF)
+            for timestamp_us, can_id, data in can_wire.decode_compact(header + remainder):
+                # back to absolute microseconds, the half keeps int() in the encoder from rounding
+                # down. Records may be before the base, so the offset from it is signed.
+                timestamp_us = base + ((timestamp_us - base + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                self.append(can_id, data, (timestamp_us + 0.5) / 1000000, 0.0)
+            # the carried records are as old as the batch they came from
+            self.deadline = deadline
+
+    def flush(self):
+        if self.offset:
+            self.complete()
+        return self.ready.popleft() if self.ready else None
+
+    def poll(self, now):
+        if self.ready:
+            return self.ready.popleft()
+        return can_bridge.FrameBatcher.poll(self, now)
+
+    def time_left(self, now):
+        if self.ready:
+            return 0.0
+        return can_bridge.FrameBatcher.time_left(self, now)
+
+
+def decode(payload, zdict):
+    # yields (timestamp_us, can_id, data) from a notification, compressed or not
+    payload = bytes(payload)
+    if can_wire.is_compact(payload) and payload[0] & FLAG_DEFLATE:
+        if zdict is None:
+            raise ValueError("deflated payload without a dictionary")
+        header_size = can_wire.COMPACT_HEADER.size
+        records = BatchCompressor(zdict).decompress(payload[header_size:])
+        payload = bytes([payload[0] & ~FLAG_DEFLATE]) + payload[1:header_size] + records
+    yield from can_wire.decode(payload)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("usage: can_compress.py <dictionary file> <candump log> ...")
+        sys.exit(1)
+    zdict = build_dictionary(sys.argv[2:])
+    with open(sys.argv[1], 'wb') as f:
+        f.write(zdict)
+    print("wrote %d byte dictionary, id %08x" % (len(zdict), dictionary_id(zdict)))
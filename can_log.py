@@ -0,0 +1,422 @@
+#!/usr/bin/python3
+#
+# Fast loading of candump logs such as the captures in BRP/Logs.
+#
+# A log line looks like "(0000001453.387832) vcan0 231#0001000000000504". Logs are read in
+# chunks and every chunk is decoded with numpy in a handful of vectorised passes: lines are
+# grouped by length, each group is laid out as a 2D character array and the timestamp, id and
+# data columns are converted in one go. Lines that do not fit the layout of their group
+# (remote frames, CAN FD frames, odd spacing) fall back to a plain Python parser.
+#
+# Frames come back as numpy structured arrays of FRAME_DTYPE. Like the bridge, extended ids
+# have CAN_EFF_FLAG set.
+#
+# A sidecar index (<log>.idx.npz) records where each block of BLOCK_FRAMES frames starts in the
+# file, the time range it covers and which frames belong to which id, so a time range or a set
+# of ids can be read back without parsing the whole log again.
+#
+# The CSV exports next to the logs ("Time Stamp,ID,Extended,Dir,Bus,LEN,D1,..,D8," with the time
+# in microseconds) hold the same frames and load into the same arrays. load() parses either kind
+# once and keeps the result in a memory mapped .npy cache next to the file, keyed by its size and
+# modification time, so loading it again takes milliseconds.
+#
+# Requires numpy.
+
+import glob
+import os
+import numpy as np
+import can_wire
+
+FRAME_DTYPE = np.dtype([('timestamp', '<f8'), ('id', '<u4'), ('dlc', 'u1'), ('data', 'u1', (8,))])
+
+CHUNK_SIZE = 8 * 1024 * 1024
+BLOCK_FRAMES = 4096
+INDEX_SUFFIX = '.idx.npz'
+
+# maps an ASCII byte to its hex digit value, 0xFF for anything else
+HEX_VALUES = np.full(256, 0xFF, dtype=np.uint8)
+HEX_VALUES[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(10)
+HEX_VALUES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+HEX_VALUES[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+
+NEWLINE = ord('\n')
+COMMA = ord(',')
+CSV_COMMAS = 14     # 13 separators and the trailing comma
+CACHE_SUFFIX = '.frames.npy'
+SEPARATORS = np.frombuffer(b'(). #', dtype=np.uint8)
+
+
+def parse_line(line):
+    # slow path for a single line, returns (timestamp, id, data) or None for anything that is not a frame
+    fields = line.split()
+    if len(fields) < 3 or not fields[0].startswith(b'(') or b'#' not in fields[2]:
+        return None
+    try:
+        timestamp = float(fields[0][1:-1])
+        can_id, data = fields[2].split(b'#', 1)
+        frame_id = int(can_id, 16)
+        if len(can_id) > 3:
+            frame_id |= can_wire.CAN_EFF_FLAG
+        if data.startswith(b'#'):
+            # CAN FD: a flags nibble follows the second '#', only the first 8 bytes are kept
+            data = data[2:]
+        if data.startswith(b'R'):
+            data = b''
+        data = bytes.fromhex(data.decode())[:8]
+    except ValueError:
+        return None
+    return timestamp, frame_id, data
+
+
+def digits_to_int(digits, base=10):
+    # digits is an (n, k) array of digit values, returns the (n,) numbers as int64.
+    # Looping over the k columns is much faster than a reduction across each row.
+    value = digits[:, 0].astype(np.int64)
+    for column in range(1, digits.shape[1]):
+        value *= base
+        value += digits[:, column]
+    return value
+
+
+def parse_group(rows):
+    # Decodes equal length lines laid out as an (n, length) uint8 array. Returns the frames and
+    # a mask of the rows that decoded, the rest have to go through parse_line.
+    n, length = rows.shape
+    frames = np.zeros(n, dtype=FRAME_DTYPE)
+    first = rows[0].tobytes()
+    close = first.find(b')')
+    dot = first.find(b'.')
+    space = first.rfind(b' ')
+    hash_pos = first.find(b'#', space)
+    if first[:1] != b'(' or not 0 < dot < close < space < hash_pos or hash_pos + 1 + 16 < length:
+        return frames, np.zeros(n, dtype=bool)
+    id_len = hash_pos - space - 1
+    data_len = length - hash_pos - 1
+    if data_len % 2 or id_len not in (3, 8):
+        return frames, np.zeros(n, dtype=bool)
+
+    seconds = rows[:, 1:dot] - ord('0')
+    fraction = rows[:, dot + 1:close] - ord('0')
+    id_digits = np.take(HEX_VALUES, rows[:, space + 1:hash_pos])
+    data_digits = np.take(HEX_VALUES, rows[:, hash_pos + 1:])
+
+    # check the whole group in one go and only work out which rows are bad if some are
+    separators = rows[:, [0, close, dot, space, hash_pos]] == SEPARATORS
+    if separators.all() and seconds.max(initial=0) <= 9 and fraction.max(initial=0) <= 9 \
+            and id_digits.max(initial=0) != 0xFF and data_digits.max(initial=0) != 0xFF:
+        ok = np.ones(n, dtype=bool)
+    else:
+        ok = separators.all(axis=1) & (seconds <= 9).all(axis=1) & (fraction <= 9).all(axis=1) \
+            & (id_digits != 0xFF).all(axis=1) & (data_digits != 0xFF).all(axis=1)
+
+    frames['timestamp'] = digits_to_int(seconds) + digits_to_int(fraction) / 10.0 ** fraction.shape[1]
+    can_ids = digits_to_int(id_digits, 16).astype(np.uint32)
+    if id_len == 8:
+        can_ids |= np.uint32(can_wire.CAN_EFF_FLAG)
+    frames['id'] = can_ids
+    frames['dlc'] = data_len // 2
+    frames['data'][:, :data_len // 2] = (data_digits[:, 0::2] << 4) | data_digits[:, 1::2]
+    return frames, ok
+
+
+def parse_chunk(chunk):
+    # Decodes a bytes object holding whole lines. Returns the frames and the offset of the start
+    # of every line that held a frame, relative to the start of chunk.
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    ends = np.flatnonzero(buf == NEWLINE)
+    if len(chunk) and (len(ends) == 0 or ends[-1] != len(chunk) - 1):
+        ends = np.append(ends, len(chunk))
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    # ignore a carriage return before the newline
+    crlf = (ends > starts) & (buf[np.maximum(ends - 1, 0)] == ord('\r'))
+    lengths = ends - starts - crlf
+
+    groups = np.unique(lengths)
+    if len(groups) == 1 and groups[0] and not crlf.any() and (np.diff(starts) == groups[0] + 1).all():
+        # every line has the same length, the chunk can be viewed as rows without copying
+        length = groups[0]
+        rows = buf[:len(starts) * (length + 1)].reshape(-1, length + 1)[:, :length] if ends[-1] < len(buf) \
+            else np.append(buf, NEWLINE).reshape(-1, length + 1)[:, :length]
+        frames, ok = parse_group(rows)
+        if ok.all():
+            return frames, starts
+
+    frames = np.zeros(len(starts), dtype=FRAME_DTYPE)
+    valid = np.zeros(len(starts), dtype=bool)
+    for length in groups:
+        if length == 0:
+            continue
+        lines = np.flatnonzero(lengths == length)
+        # every window of length bytes is a view into buf, picking rows only copies the lines
+        rows = np.lib.stride_tricks.sliding_window_view(buf, length)[starts[lines]]
+        group, ok = parse_group(rows)
+        if ok.all():
+            frames[lines] = group
+            valid[lines] = True
+            continue
+        frames[lines[ok]] = group[ok]
+        valid[lines[ok]] = True
+        for line in lines[~ok]:
+            frame = parse_line(chunk[starts[line]:starts[line] + length])
+            if frame is not None:
+                timestamp, can_id, data = frame
+                frames[line] = (timestamp, can_id, len(data), np.frombuffer(data.ljust(8, b'\x00'), dtype=np.uint8))
+                valid[line] = True
+    return frames[valid], starts[valid]
+
+
+def parse_csv_line(line):
+    # slow path for a single CSV line, returns (timestamp, id, data) or None for anything that is not a frame
+    fields = line.rstrip(b'\r\n').split(b',')
+    if len(fields) < 6:
+        return None
+    try:
+        timestamp = int(fields[0]) / 1000000.0
+        frame_id = int(fields[1], 16)
+        if fields[2].strip().lower() == b'true':
+            frame_id |= can_wire.CAN_EFF_FLAG
+        length = min(int(fields[5]), 8)
+        data = bytes(int(field, 16) for field in fields[6:6 + length])
+    except ValueError:
+        return None
+    if len(data) != length:
+        return None
+    return timestamp, frame_id, data
+
+
+def gather_right(buf, ends, width):
+    # (n, width) array of the width bytes before each end offset
+    return np.lib.stride_tricks.sliding_window_view(buf, width)[ends - width]
+
+
+def parse_csv_chunk(chunk):
+    # Decodes a bytes object holding whole CSV lines, like parse_chunk. The fields are located
+    # from the comma positions of each line: regular lines have CSV_COMMAS commas and fixed width
+    # fields after the time stamp. Everything else (the header, short rows) goes through parse_csv_line.
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    ends = np.flatnonzero(buf == NEWLINE)
+    if len(chunk) and (len(ends) == 0 or ends[-1] != len(chunk) - 1):
+        ends = np.append(ends, len(chunk))
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    commas = np.flatnonzero(buf == COMMA)
+    comma_lines = np.searchsorted(ends, commas)
+    regular = np.bincount(comma_lines, minlength=len(ends)) == CSV_COMMAS
+    lines = np.flatnonzero(regular)
+    pos = commas[regular[comma_lines]].reshape(-1, CSV_COMMAS)
+    # time stamp is left of the first comma, up to 19 digits
+    time_width = pos[:, 0] - starts[lines]
+    # id, extended, dir, bus and len fields, then eight 2 digit data fields
+    widths = np.diff(pos, axis=1)
+    ok = (time_width > 0) & (time_width < 19) & (widths[:, 0] == 9) & (widths[:, 4] == 2) \
+        & (widths[:, 5:] == 3).all(axis=1)
+
+    frames = np.zeros(len(starts), dtype=FRAME_DTYPE)
+    valid = np.zeros(len(starts), dtype=bool)
+    if len(lines) and ok.any():
+        lines = lines[ok]
+        pos = pos[ok]
+        time_width = time_width[ok]
+        max_width = int(time_width.max())
+        digits = gather_right(buf, pos[:, 0], max_width) - ord('0')
+        # blank out whatever precedes a shorter time stamp
+        digits[np.arange(max_width)[::-1] >= time_width[:, None]] = 0
+        id_digits = np.take(HEX_VALUES, gather_right(buf, pos[:, 1], 8))
+        length = buf[pos[:, 4] + 1] - ord('0')
+        # eight "HH," fields in a row, drop the commas
+        data_digits = np.take(HEX_VALUES, gather_right(buf, pos[:, 13] + 1, 24).reshape(-1, 8, 3)[:, :, :2])
+        good = (digits <= 9).all(axis=1) & (id_digits != 0xFF).all(axis=1) & (length <= 8) \
+            & (data_digits != 0xFF).all(axis=(1, 2))
+        can_ids = digits_to_int(id_digits, 16).astype(np.uint32)
+        can_ids[buf[pos[:, 1] + 1] == ord('t')] |= np.uint32(can_wire.CAN_EFF_FLAG)
+        data = (data_digits[:, :, 0] << 4) | data_digits[:, :, 1]
+        data[np.arange(8) >= length[:, None]] = 0
+        frames['timestamp'][lines] = digits_to_int(digits) / 1000000.0
+        frames['id'][lines] = can_ids
+        frames['dlc'][lines] = length
+        frames['data'][lines] = data
+        valid[lines[good]] = True
+    for line in np.flatnonzero(~valid):
+        frame = parse_csv_line(chunk[starts[line]:ends[line]])
+        if frame is not None:
+            timestamp, can_id, data = frame
+            frames[line] = (timestamp, can_id, len(data), np.frombuffer(data.ljust(8, b'\x00'), dtype=np.uint8))
+            valid[line] = True
+    return frames[valid], starts[valid]
+
+
+def iter_chunks(path, start=0, stop=None, chunk_size=CHUNK_SIZE, parser=parse_chunk):
+    # Yields (frames, line offsets) for consecutive chunks of the file between the byte
+    # offsets start and stop. Offsets are absolute positions in the file.
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        carry = b''
+        while stop is None or position < stop:
+            size = chunk_size if stop is None else min(chunk_size, stop - position)
+            data = f.read(size)
+            if not data:
+                break
+            position += len(data)
+            data = carry + data
+            cut = data.rfind(b'\n') + 1
+            if cut == 0:
+                carry = data
+                continue
+            carry = data[cut:]
+            frames, offsets = parser(data[:cut])
+            yield frames, offsets + (position - len(data))
+        if carry:
+            frames, offsets = parser(carry)
+            yield frames, offsets + (position - len(carry))
+
+
+def read_log(path, chunk_size=CHUNK_SIZE):
+    # parses the whole log into one array of FRAME_DTYPE
+    chunks = [frames for frames, offsets in iter_chunks(path, chunk_size=chunk_size)]
+    if not chunks:
+        return np.zeros(0, dtype=FRAME_DTYPE)
+    return np.concatenate(chunks)
+
+
+def read_csv(path, chunk_size=CHUNK_SIZE):
+    # parses a whole CSV export into one array of FRAME_DTYPE
+    chunks = [frames for frames, offsets in iter_chunks(path, chunk_size=chunk_size, parser=parse_csv_chunk)]
+    if not chunks:
+        return np.zeros(0, dtype=FRAME_DTYPE)
+    return np.concatenate(chunks)
+
+
+def cache_path(path):
+    stat = os.stat(path)
+    return '%s.%d-%d%s' % (path, stat.st_size, stat.st_mtime_ns, CACHE_SUFFIX)
+
+
+def load(path):
+    # Returns the frames of a candump log or CSV export as a read only memory mapped array.
+    # The first load parses the file and writes the cache, a changed file gets a new cache.
+    cache = cache_path(path)
+    try:
+        return np.load(cache, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    frames = read_csv(path) if path.lower().endswith('.csv') else read_log(path)
+    for stale in glob.glob(glob.escape(path) + '.*' + CACHE_SUFFIX):
+        os.remove(stale)
+    partial = cache + '.tmp'
+    with open(partial, 'wb') as f:
+        np.save(f, frames)
+    os.replace(partial, cache)
+    return np.load(cache, mmap_mode='r')
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_index(path):
+    # parses the log once and writes the sidecar index, returns the index as a dict of arrays
+    stat = os.stat(path)
+    timestamps = []
+    ids = []
+    offsets = []
+    for frames, line_offsets in iter_chunks(path):
+        timestamps.append(frames['timestamp'])
+        ids.append(frames['id'])
+        offsets.append(line_offsets)
+    timestamps = np.concatenate(timestamps) if timestamps else np.zeros(0)
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.uint32)
+    offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+
+    # per block: where it starts and the time range it covers (captures can jump back in time)
+    block_starts = np.arange(0, len(ids), BLOCK_FRAMES)
+    block_ends = np.append(block_starts[1:], len(ids))
+    if len(ids):
+        block_min = np.minimum.reduceat(timestamps, block_starts)
+        block_max = np.maximum.reduceat(timestamps, block_starts)
+    else:
+        block_min = block_max = np.zeros(0)
+
+    # per id: the frame numbers it appears at, stored back to back
+    order = np.argsort(ids, kind='stable')
+    unique_ids, id_starts, id_counts = np.unique(ids[order], return_index=True, return_counts=True)
+
+    index = {
+        'source_size': np.int64(stat.st_size),
+        'source_mtime_ns': np.int64(stat.st_mtime_ns),
+        'frame_count': np.int64(len(ids)),
+        'block_offsets': offsets[block_starts],
+        'block_ends': np.append(offsets[block_ends[:-1]], stat.st_size) if len(ids) else np.zeros(0, dtype=np.int64),
+        'block_min': block_min,
+        'block_max': block_max,
+        'ids': unique_ids,
+        'id_starts': id_starts,
+        'id_counts': id_counts,
+        'id_frames': order,
+    }
+    with open(index_path(path), 'wb') as f:
+        np.savez(f, **index)
+    return index
+
+
+def load_index(path):
+    # returns the sidecar index, rebuilding it if it is missing or older than the log
+    stat = os.stat(path)
+    try:
+        with np.load(index_path(path)) as data:
+            index = {key: data[key] for key in data.files}
+        if index['source_size'] == stat.st_size and index['source_mtime_ns'] == stat.st_mtime_ns:
+            return index
+    except (OSError, KeyError, ValueError):
+        pass
+    return build_index(path)
+
+
+def read_blocks(path, index, blocks):
+    # parses only the given blocks of the log
+    chunks = []
+    for block in blocks:
+        for frames, offsets in iter_chunks(path, int(index['block_offsets'][block]), int(index['block_ends'][block])):
+            chunks.append(frames)
+    if not chunks:
+        return np.zeros(0, dtype=FRAME_DTYPE)
+    return np.concatenate(chunks)
+
+
+def read_time_range(path, start, stop):
+    # frames with start <= timestamp < stop, in file order
+    index = load_index(path)
+    blocks = np.flatnonzero((index['block_max'] >= start) & (index['block_min'] < stop))
+    frames = read_blocks(path, index, blocks)
+    return frames[(frames['timestamp'] >= start) & (frames['timestamp'] < stop)]
+
+
+def read_ids(path, can_ids):
+    # frames with any of the given ids, in file order
+    index = load_index(path)
+    wanted = np.isin(index['ids'], np.asarray(can_ids, dtype=np.uint32))
+    frame_numbers = np.concatenate([index['id_frames'][s:s + c] for s, c in
+                                    zip(index['id_starts'][wanted], index['id_counts'][wanted])] or [np.zeros(0, dtype=np.int64)])
+    blocks = np.unique(frame_numbers // BLOCK_FRAMES)
+    frames = read_blocks(path, index, blocks)
+    return frames[np.isin(frames['id'], np.asarray(can_ids, dtype=np.uint32))]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    for log in sys.argv[1:]:
+        started = time.perf_counter()
+        frames = read_csv(log) if log.lower().endswith('.csv') else read_log(log)
+        elapsed = time.perf_counter() - started
+        if not log.lower().endswith('.csv'):
+            build_index(log)
+        load(log)
+        started = time.perf_counter()
+        load(log)
+        cached = time.perf_counter() - started
+        print("%s: %d frames, %d ids, %.1f ms, %.2f M frames/s, %.2f ms from cache" % (
+            log, len(frames), len(np.unique(frames['id'])), elapsed * 1000, len(frames) / elapsed / 1e6, cached * 1000))
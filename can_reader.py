@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+#
+# Reads any number of CAN buses on a single thread.
+#
+# Each bus is opened with one of two backends and its socket is registered with a selector
+# (epoll on Linux). Whenever a socket is readable, everything waiting on it is queued in that
+# bus's FrameRing (see can_bridge.py), so a busy bus delays the others by at most one drain.
+#
+# LoopReader does the same on an asyncio event loop instead of a thread of its own: the sockets
+# are watched with loop.add_reader and what was read is handed straight to a callback on the
+# loop, with no FrameRing in between (see ble5_can0_async.py).
+#
+# BACKEND_PYTHON_CAN opens the bus through python-can, whose frames carry the time the kernel
+# received them. BACKEND_SOCKET opens a raw socket (see can_socket.py) that uses the CAN
+# controller's hardware receive timestamps where it has them, and with a batch size above 1
+# reads many frames per system call with recvmmsg() without building a python-can Message
+# for each.
+
+import os
+import selectors
+import threading
+import can
+import bluetooth_log
+import can_socket
+import can_wire
+
+log = bluetooth_log.get_logger('can')
+
+BACKEND_PYTHON_CAN = 'python-can'
+BACKEND_SOCKET = 'socket'
+
+
+class BusReader:
+    """
+    One bus being read through python-can: its bus, the ring its frames go to and its
+    counters. Frames received and dropped are counted by the ring.
+    """
+
+    def __init__(self, channel, bus, ring):
+        self.channel = channel
+        self.bus = bus
+        self.ring = ring
+        self.error_frames = 0
+
+    def fileno(self):
+        return self.bus.fileno()
+
+    def set_filters(self, filters):
+        self.bus.set_filters(filters or None)
+
+    def read(self):
+        # queues every frame waiting on the socket
+        bus = self.bus
+        put = self.ring.put
+        msg = bus.recv(0)
+        while msg is not None:
+            if msg.is_error_frame:
+                self.error_frames += 1
+            else:
+                can_id = msg.arbitration_id | can_wire.CAN_EFF_FLAG if msg.is_extended_id else msg.arbitration_id
+                put((can_id, msg.data, msg.timestamp))
+            msg = bus.recv(0)
+
+    def send(self, can_id, data, timeout=None):
+        # returns whether the frame was sent within timeout, raises ValueError like
+        # can_socket.CanSocket.send for an invalid id or data
+        can_wire.check_frame(can_id, data)
+        extended = bool(can_id & can_wire.CAN_EFF_FLAG)
+        msg = can.Message(
+            arbitration_id=can_id & (can_wire.CAN_EFF_MASK if extended else can_wire.CAN_SFF_MASK),
+            is_extended_id=extended,
+            data=data)
+        try:
+            self.bus.send(msg, timeout)
+            return True
+        except can.CanError:
+            return False
+
+    def close(self):
+        self.bus.shutdown()
+
+
+class SocketReader:
+    """
+    One bus being read through a can_socket.CanSocket, interchangeable with BusReader.
+    """
+
+    def __init__(self, channel, sock, ring):
+        self.channel = channel
+        self.sock = sock
+        self.ring = ring
+
+    @property
+    def error_frames(self):
+        return self.sock.error_frames
+
+    @property
+    def hardware_timestamps(self):
+        return self.sock.hardware_timestamps
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def set_filters(self, filters):
+        self.sock.set_filters(filters)
+
+    def read(self):
+        recv_batch = self.sock.recv_batch
+        extend = self.ring.extend
+        frames = recv_batch()
+        while frames:
+            extend(frames)
+            frames = recv_batch()
+
+    def send(self, can_id, data, timeout=None):
+        return self.sock.send(can_id, data, timeout)
+
+    def close(self):
+        self.sock.close()
+
+
+def open_reader(channel, ring, filters, backend, bustype, timestamps, batch):
+    if backend == BACKEND_SOCKET:
+        return SocketReader(channel, can_socket.CanSocket(channel, timestamps, filters, batch), ring)
+    bus = can.interface.Bus(channel=channel, bustype=bustype, can_filters=filters or None)
+    return BusReader(channel, bus, ring)
+
+
+def close_reader(reader):
+    # for a reader that failed, whose bus may not shut down cleanly either
+    try:
+        reader.close()
+    except (OSError, can.CanError) as e:
+        log.warning("%s: error closing the bus: %s", reader.channel, e)
+
+
+class FrameList(list):
+    """
+    Takes the place of a FrameRing for LoopReader, collecting what one read() puts in it.
+    """
+    put = list.append
+
+
+class MultiBusReader:
+    """
+    Multiplexes bus readers on one thread with a selector.
+    """
+
+    def __init__(self, backend=BACKEND_PYTHON_CAN, bustype='socketcan', timestamps=can_socket.TIMESTAMP_HARDWARE, batch=64):
+        self.backend = backend
+        self.bustype = bustype
+        self.timestamps = timestamps
+        self.batch = batch
+        self.selector = selectors.DefaultSelector()
+        self.readers = {}
+        self.thread = None
+        self.stopped = False
+        # wakes the thread up from select() when stopping
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+    def add(self, channel, ring, filters=None):
+        reader = open_reader(channel, ring, filters, self.backend, self.bustype, self.timestamps, self.batch)
+        self.readers[channel] = reader
+        self.selector.register(reader.fileno(), selectors.EVENT_READ, reader)
+        return reader
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped:
+            for key, events in self.selector.select():
+                if key.data is not None:
+                    try:
+                        key.data.read()
+                    except (OSError, can.CanError) as e:
+                        # e.g. the interface went away, the other buses are still read
+                        log.error("%s: cannot read the bus, closing it: %s", key.data.channel, e)
+                        self.remove(key.data)
+
+    def remove(self, reader):
+        self.selector.unregister(reader.fileno())
+        del self.readers[reader.channel]
+        close_reader(reader)
+
+    def stop(self):
+        self.stopped = True
+        os.write(self.wakeup_w, b'\x01')
+        if self.thread is not None:
+            self.thread.join()
+        for reader in self.readers.values():
+            self.selector.unregister(reader.fileno())
+            reader.close()
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+
+class LoopReader:
+    """
+    Reads buses on an asyncio event loop. Whenever a bus's socket is readable, everything
+    waiting on it is passed to that bus's on_frames callback as one list of frames, which is
+    only valid during the call.
+    """
+
+    def __init__(self, loop, backend=BACKEND_PYTHON_CAN, bustype='socketcan', timestamps=can_socket.TIMESTAMP_HARDWARE, batch=64):
+        self.loop = loop
+        self.backend = backend
+        self.bustype = bustype
+        self.timestamps = timestamps
+        self.batch = batch
+        self.readers = {}
+
+    def add(self, channel, on_frames, filters=None):
+        reader = open_reader(channel, FrameList(), filters, self.backend, self.bustype, self.timestamps, self.batch)
+        self.readers[channel] = reader
+        self.loop.add_reader(reader.fileno(), self.read, reader, on_frames)
+        return reader
+
+    def read(self, reader, on_frames):
+        frames = reader.ring
+        try:
+            reader.read()
+        except (OSError, can.CanError) as e:
+            log.error("%s: cannot read the bus, closing it: %s", reader.channel, e)
+            self.loop.remove_reader(reader.fileno())
+            del self.readers[reader.channel]
+            close_reader(reader)
+        if frames:
+            on_frames(frames)
+            frames.clear()
+
+    def stop(self):
+        for reader in self.readers.values():
+            self.loop.remove_reader(reader.fileno())
+            reader.close()
+        self.readers.clear()
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+#
+# Replays a candump log or CSV export from BRP/Logs, either onto a SocketCAN interface or into
+# any callable taking (can_id, data, timestamp), e.g. the frame ring of ble5_can0.py.
+#
+# The file is read one line at a time so a capture of any size can be replayed. Frames go out
+# with their original spacing, sped up by a factor, or as fast as possible. Where the log's
+# timestamps jump backwards (the capture was restarted) the replay carries on from the next frame.
+#
+#   python3 can_replay.py vcan0 "BRP/Logs/IBR Pull.log"          original timing
+#   python3 can_replay.py -s 4 vcan0 "BRP/Logs/IBR Pull.log"     4 times faster
+#   python3 can_replay.py -f vcan0 "BRP/Logs/IBR Pull.log"       as fast as possible
+#
+# Reading a file needs numpy (the lines are parsed by can_log.py), the SocketCAN output
+# needs python-can.
+
+import argparse
+import threading
+import time
+import can_wire
+
+SPIN = 0.0002           # the last part of a wait is spent polling the clock, sleep() overshoots
+BUCKET = 0.00001        # lateness histogram resolution, 10 us
+BUCKETS = 10000         # lateness of 100 ms or more goes in the last bucket
+
+
+def read_frames(path):
+    # yields (can_id, data, timestamp) for every frame in the file, lazily, parsed one line at a
+    # time by can_log's parsers
+    import can_log
+    parse = can_log.parse_csv_line if path.lower().endswith('.csv') else can_log.parse_line
+    with open(path, 'rb') as f:
+        for line in f:
+            frame = parse(line)
+            if frame is not None:
+                timestamp, can_id, data = frame
+                yield can_id, data, timestamp
+
+
+class SocketCanSink:
+    """
+    Sends replayed frames on a SocketCAN interface such as vcan0.
+    """
+
+    def __init__(self, channel):
+        import can
+        self.can = can
+        self.bus = can.interface.Bus(channel=channel, bustype='socketcan')
+
+    def __call__(self, can_id, data, timestamp):
+        extended = bool(can_id & can_wire.CAN_EFF_FLAG)
+        self.bus.send(self.can.Message(
+            arbitration_id=can_id & (can_wire.CAN_EFF_MASK if extended else can_wire.CAN_SFF_MASK),
+            is_extended_id=extended,
+            data=data))
+
+    def close(self):
+        self.bus.shutdown()
+
+
+class ReplayStats:
+    """
+    Frames sent and how late they went out compared to the log's timing.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.elapsed = 0.0
+        self.log_time = 0.0     # time covered by the log, as replayed
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.histogram = [0] * BUCKETS
+
+    def add(self, lateness):
+        self.frames += 1
+        self.total_lateness += lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        self.histogram[min(int(lateness / BUCKET), BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        # upper edge of the bucket holding the p-th percentile lateness, in seconds
+        wanted = self.frames * p / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= wanted:
+                return min((bucket + 1) * BUCKET, self.max_lateness)
+        return 0.0
+
+    def frame_rate(self):
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        mean = self.total_lateness / self.frames if self.frames else 0.0
+        return ("%d frames in %.3f s (%.3f s of log), %.0f frames/s, lateness mean %.0f us, "
+                "p50 %.0f us, p99 %.0f us, max %.0f us" % (
+                    self.frames, self.elapsed, self.log_time, self.frame_rate(), mean * 1e6,
+                    self.percentile(50) * 1e6, self.percentile(99) * 1e6, self.max_lateness * 1e6))
+
+
+class Replayer:
+    """
+    Sends frames to sink at the times given by their timestamps, divided by speed. A speed of
+    0 (or None) sends them as fast as possible. Lateness is measured against the time each
+    frame was due, so it shows the jitter of the replay.
+    """
+
+    def __init__(self, frames, sink, speed=1.0):
+        self.frames = frames
+        self.sink = sink
+        self.speed = speed
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        stats = ReplayStats()
+        clock = time.perf_counter
+        started = clock()
+        log_start = None
+        last_timestamp = None
+        for can_id, data, timestamp in self.frames:
+            if self.stopped.is_set():
+                break
+            if last_timestamp is None or timestamp < last_timestamp:
+                # first frame, or the capture restarted: line the log up with the clock again
+                if last_timestamp is not None:
+                    stats.log_time += last_timestamp - log_start
+                log_start = timestamp
+                start = clock()
+            lateness = 0.0
+            if self.speed:
+                due = start + (timestamp - log_start) / self.speed
+                wait = due - clock()
+                # stop() wakes the wait early, logs can have long gaps
+                if wait > SPIN and self.stopped.wait(wait - SPIN):
+                    break
+                now = clock()
+                while now < due:
+                    now = clock()
+                lateness = now - due
+            last_timestamp = timestamp
+            self.sink(can_id, data, timestamp)
+            stats.add(lateness)
+        if last_timestamp is not None:
+            stats.log_time += last_timestamp - log_start
+        stats.elapsed = clock() - started
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a CAN log with its original timing")
+    parser.add_argument('channel', help="SocketCAN interface, e.g. vcan0")
+    parser.add_argument('log', help="candump .log or .csv export")
+    parser.add_argument('-s', '--speed', type=float, default=1.0, help="speed up factor (default 1)")
+    parser.add_argument('-f', '--fast', action='store_true', help="send as fast as possible")
+    args = parser.parse_args()
+    sink = SocketCanSink(args.channel)
+    replayer = Replayer(read_frames(args.log), sink, 0 if args.fast else args.speed)
+    try:
+        print(replayer.run().summary())
+    finally:
+        sink.close()
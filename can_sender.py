@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+#
+# Sends frames written by the phone onto a CAN bus.
+#
+# The main loop decodes each write and queues its frames; a worker thread takes them off the
+# queue and sends them, so a slow or busy bus never blocks GATT traffic. When the queue fills
+# past a high watermark the sender reports itself paused, and ready again once the worker has
+# brought it down to a low watermark, so the phone can hold off instead of losing frames.
+
+import queue
+import struct
+import threading
+
+# transmit status: flags, free queue slots, frames dropped because the queue was full
+STATUS = struct.Struct('>BHI')
+STATUS_PAUSED = 0x01
+
+
+class FrameSender:
+    """
+    Bounded queue of (can_id, data) frames and the worker sending them on bus, a
+    can_reader.BusReader or SocketReader.
+    on_pause is called with True or False whenever the paused state changes, from the main
+    loop when pausing and from the worker thread when resuming.
+    """
+
+    def __init__(self, bus, capacity=1024, high=768, low=256, on_pause=None, timeout=0.1):
+        self.bus = bus
+        self.capacity = capacity
+        self.high = high
+        self.low = low
+        self.on_pause = on_pause
+        self.timeout = timeout
+        self.frames = queue.Queue(capacity)
+        self.paused = False
+        self.pause_lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, frames):
+        # queues what fits and returns how many frames were accepted
+        accepted = 0
+        for frame in frames:
+            try:
+                self.frames.put_nowait(frame)
+            except queue.Full:
+                self.dropped += len(frames) - accepted
+                break
+            accepted += 1
+        self.update_paused()
+        return accepted
+
+    def update_paused(self):
+        # the check and the change are made under the lock so pausing and resuming cannot cross
+        with self.pause_lock:
+            depth = self.frames.qsize()
+            if self.paused:
+                paused = depth > self.low
+            else:
+                paused = depth >= self.high
+            if paused == self.paused:
+                return
+            self.paused = paused
+            if self.on_pause is not None:
+                self.on_pause(self.paused)
+
+    def status(self):
+        flags = STATUS_PAUSED if self.paused else 0
+        return STATUS.pack(flags, max(0, self.capacity - self.frames.qsize()), self.dropped & 0xFFFFFFFF)
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            can_id, data = frame
+            # waits up to timeout for room in the socket's transmit queue
+            try:
+                sent = self.bus.send(can_id, data, self.timeout)
+            except ValueError:
+                sent = False
+            if sent:
+                self.sent += 1
+            else:
+                self.errors += 1
+            if self.paused:
+                self.update_paused()
+
+    def stop(self):
+        self.frames.put(None)
+        self.thread.join()
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+#
+# Raw SocketCAN sockets with hardware receive timestamps.
+#
+# python-can stamps each frame with the time the kernel queued it on the socket (SO_TIMESTAMPNS),
+# which on a busy Raspberry Pi can be well after the frame was on the wire. Here the socket asks
+# for SO_TIMESTAMPING instead: the kernel then reports its software timestamp and, with CAN
+# controllers that have one (e.g. the MCP2518FD), the time the controller received the frame.
+# The hardware time is used when there is one and the software time otherwise, so the frame
+# timestamps carried to the phone by the compact format are as close to the bus as the
+# hardware allows.
+#
+# The software timestamp is in seconds since the epoch like time.time(). The hardware one is
+# only on that clock when the driver converts the controller's counter to system time or the
+# clock is synchronised with PTP; others count from when the controller started. A hardware
+# time more than HW_CLOCK_TOLERANCE away from the software time of the same frame is taken to
+# be on another clock and the software time is used instead. Linux only; needs nothing but the
+# standard library.
+#
+# With a batch size above 1, recv_batch() reads up to that many frames per system call with
+# recvmmsg(), called through ctypes into buffers allocated once, and unpacks the frames and
+# their timestamps from those buffers in bulk. That saves a system call, a control message
+# parse and (compared to python-can) a Message object per frame on busy buses.
+
+import ctypes
+import errno
+import os
+import socket
+import struct
+import time
+import can_wire
+
+CAN_FRAME = struct.Struct('=IB3x8s')    # struct can_frame: id and flags, length, padding, data
+
+SOL_CAN_RAW = socket.SOL_CAN_RAW
+CAN_RAW_FILTER = socket.CAN_RAW_FILTER
+CAN_RAW_ERR_FILTER = 2
+CAN_RTR_FLAG = socket.CAN_RTR_FLAG
+CAN_ERR_FLAG = socket.CAN_ERR_FLAG
+CAN_ERR_MASK = socket.CAN_ERR_MASK
+KERNEL_FILTER = struct.Struct('=II')    # struct can_filter: id, mask
+
+# SO_TIMESTAMPING and its control message report struct scm_timestamping, three struct timespec:
+# the software timestamp, a deprecated one and the raw hardware timestamp
+SO_TIMESTAMPING = 37
+SOF_TIMESTAMPING_RX_HARDWARE = 1 << 2
+SOF_TIMESTAMPING_RX_SOFTWARE = 1 << 3
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_RAW_HARDWARE = 1 << 6
+TIMESTAMPING = struct.Struct('@llllll')
+ANCILLARY_SIZE = socket.CMSG_SPACE(TIMESTAMPING.size)
+# the SO_TIMESTAMPING control message as recvmmsg() leaves it in each message's control
+# buffer: struct cmsghdr (length, level, type) followed by struct scm_timestamping
+CONTROL = struct.Struct('@Nii6l%dx' % (ANCILLARY_SIZE - struct.calcsize('@Nii6l')))
+MSG_DONTWAIT = 0x40
+
+TIMESTAMP_HARDWARE = 'hardware'
+TIMESTAMP_SOFTWARE = 'software'
+HW_CLOCK_TOLERANCE = 1.0    # seconds
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+try:
+    recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+    recvmmsg = None
+
+
+def kernel_filters(filters):
+    # python-can filter dicts to the packed struct can_filter list CAN_RAW_FILTER takes,
+    # matching extended and standard frames like python-can does
+    value = bytearray()
+    for f in filters:
+        can_id = f['can_id']
+        can_mask = f['can_mask']
+        if 'extended' in f:
+            can_mask |= can_wire.CAN_EFF_FLAG | CAN_RTR_FLAG
+            if f['extended']:
+                can_id |= can_wire.CAN_EFF_FLAG
+        value += KERNEL_FILTER.pack(can_id, can_mask)
+    return bytes(value)
+
+
+class CanSocket:
+    """
+    Non-blocking raw CAN socket bound to one interface. recv() returns (can_id, data,
+    timestamp) frames like the rest of the bridge, with CAN_EFF_FLAG set in extended ids,
+    or None once nothing is waiting. recv_batch() returns a list of up to batch frames,
+    empty once nothing is waiting. Error frames are counted and skipped.
+    """
+
+    def __init__(self, channel, timestamps=TIMESTAMP_HARDWARE, filters=None, batch=1):
+        self.channel = channel
+        self.hardware = timestamps == TIMESTAMP_HARDWARE
+        self.error_frames = 0
+        self.hardware_timestamps = 0
+        self.batch = batch
+        self.messages = None
+        if batch > 1 and recvmmsg is not None:
+            self.allocate(batch)
+        self.sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        try:
+            flags = SOF_TIMESTAMPING_RX_SOFTWARE | SOF_TIMESTAMPING_SOFTWARE
+            if self.hardware:
+                flags |= SOF_TIMESTAMPING_RX_HARDWARE | SOF_TIMESTAMPING_RAW_HARDWARE
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING, flags)
+            self.sock.setsockopt(SOL_CAN_RAW, CAN_RAW_ERR_FILTER, CAN_ERR_MASK)
+            self.set_filters(filters)
+            self.sock.bind((channel,))
+            self.sock.setblocking(False)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def allocate(self, batch):
+        # one frame buffer and one control buffer per message, described by batch mmsghdrs
+        self.frame_buffer = ctypes.create_string_buffer(batch * CAN_FRAME.size)
+        self.control_buffer = ctypes.create_string_buffer(batch * ANCILLARY_SIZE)
+        self.iovecs = (iovec * batch)()
+        self.messages = (mmsghdr * batch)()
+        frames = ctypes.addressof(self.frame_buffer)
+        controls = ctypes.addressof(self.control_buffer)
+        for i in range(batch):
+            self.iovecs[i].iov_base = frames + i * CAN_FRAME.size
+            self.iovecs[i].iov_len = CAN_FRAME.size
+            hdr = self.messages[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_control = controls + i * ANCILLARY_SIZE
+            hdr.msg_controllen = ANCILLARY_SIZE
+        self.frame_view = memoryview(self.frame_buffer).cast('B')
+        self.control_view = memoryview(self.control_buffer).cast('B')
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def set_filters(self, filters):
+        # no filters receives every frame
+        if filters:
+            self.sock.setsockopt(SOL_CAN_RAW, CAN_RAW_FILTER, kernel_filters(filters))
+        else:
+            self.sock.setsockopt(SOL_CAN_RAW, CAN_RAW_FILTER, KERNEL_FILTER.pack(0, 0))
+
+    def timestamp(self, ancdata):
+        for level, kind, value in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPING and len(value) >= TIMESTAMPING.size:
+                sw_sec, sw_nsec, _, _, hw_sec, hw_nsec = TIMESTAMPING.unpack_from(value)
+                software = sw_sec + sw_nsec * 1e-9
+                # a driver without hardware timestamps leaves them zero
+                if self.hardware and (hw_sec or hw_nsec):
+                    hardware = hw_sec + hw_nsec * 1e-9
+                    if abs(hardware - software) < HW_CLOCK_TOLERANCE:
+                        self.hardware_timestamps += 1
+                        return hardware
+                if sw_sec or sw_nsec:
+                    return software
+        return time.time()
+
+    def recv(self):
+        while True:
+            try:
+                frame, ancdata, flags, address = self.sock.recvmsg(CAN_FRAME.size, ANCILLARY_SIZE)
+            except BlockingIOError:
+                return None
+            can_id, length, data = CAN_FRAME.unpack(frame)
+            if can_id & CAN_ERR_FLAG:
+                self.error_frames += 1
+                continue
+            if can_id & CAN_RTR_FLAG:
+                data = b''
+            else:
+                data = data[:length]
+            if can_id & can_wire.CAN_EFF_FLAG:
+                can_id &= can_wire.CAN_EFF_FLAG | can_wire.CAN_EFF_MASK
+            else:
+                can_id &= can_wire.CAN_SFF_MASK
+            return can_id, data, self.timestamp(ancdata)
+
+    def recv_batch(self):
+        if self.messages is None:
+            frame = self.recv()
+            return [] if frame is None else [frame]
+        count = recvmmsg(self.sock.fileno(), self.messages, self.batch, MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise OSError(error, os.strerror(error))
+        # The kernel overwrites msg_controllen with the control data it wrote, and msg_flags, so
+        # both are set again for the next call. A message that came without its timestamp has
+        # the stale one in its control buffer cleared so the time of reading is used instead.
+        messages = self.messages
+        control_view = self.control_view
+        for i in range(count):
+            hdr = messages[i].msg_hdr
+            if hdr.msg_controllen < ANCILLARY_SIZE or hdr.msg_flags & socket.MSG_CTRUNC:
+                control_view[i * ANCILLARY_SIZE:(i + 1) * ANCILLARY_SIZE] = bytes(ANCILLARY_SIZE)
+            hdr.msg_controllen = ANCILLARY_SIZE
+            hdr.msg_flags = 0
+        batch = []
+        append = batch.append
+        hardware = self.hardware
+        for (can_id, length, data), (_, level, kind, sw_sec, sw_nsec, _, _, hw_sec, hw_nsec) in zip(
+                CAN_FRAME.iter_unpack(self.frame_view[:count * CAN_FRAME.size]),
+                CONTROL.iter_unpack(self.control_view[:count * ANCILLARY_SIZE])):
+            if can_id & CAN_ERR_FLAG:
+                self.error_frames += 1
+                continue
+            if can_id & CAN_RTR_FLAG:
+                data = b''
+            else:
+                data = data[:length]
+            if can_id & can_wire.CAN_EFF_FLAG:
+                can_id &= can_wire.CAN_EFF_FLAG | can_wire.CAN_EFF_MASK
+            else:
+                can_id &= can_wire.CAN_SFF_MASK
+            if kind != SO_TIMESTAMPING or level != socket.SOL_SOCKET:
+                timestamp = time.time()
+            else:
+                timestamp = sw_sec + sw_nsec * 1e-9
+                if hardware and (hw_sec or hw_nsec):
+                    hw_timestamp = hw_sec + hw_nsec * 1e-9
+                    if abs(hw_timestamp - timestamp) < HW_CLOCK_TOLERANCE:
+                        self.hardware_timestamps += 1
+                        timestamp = hw_timestamp
+            append((can_id, data, timestamp))
+        return batch
+
+    def send(self, can_id, data, timeout=None):
+        # waits up to timeout for room in the interface's transmit queue, returns whether the
+        # frame was sent. A full queue shows up as ENOBUFS rather than the socket blocking or
+        # becoming unwritable, so it is polled. Raises ValueError for an invalid id or data,
+        # see can_wire.check_frame, so no RTR or error frame can be sent.
+        can_wire.check_frame(can_id, data)
+        frame = CAN_FRAME.pack(can_id, len(data), bytes(data))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                self.sock.send(frame)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.ENOBUFS, errno.EAGAIN):
+                    return False
+            wait = 0.001 if deadline is None else min(0.001, deadline - time.monotonic())
+            if wait <= 0:
+                return False
+            time.sleep(wait)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+#
+# Counters and histograms describing how the CAN bridge keeps up, readable over BLE through
+# the CAN statistics characteristic and locally in the Prometheus text format.
+#
+# Recording is kept off the per frame path: the counters are plain integer attributes of the
+# objects that already handle each frame (FrameRing.received, CanBridge.frames_sent, ...) and
+# Stats only reads them when asked. Histograms are recorded once per drain or notification.
+#
+# Statistics characteristic value, big endian: 1 byte STATS_VERSION, then one entry per metric
+# in the order they were registered. Counters and gauges are 4 bytes (counters wrap at 2**32).
+# Histograms of seconds are 16 bytes: the number of samples, then p50, p99 and the maximum in
+# microseconds. The percentiles are the upper bounds of the buckets they fall in.
+#
+# A summary (encode_summary()) starts with STATS_SUMMARY instead and holds only the 4 byte
+# values of the counters and gauges asked for, in the order asked, so it can be small enough
+# for a notification at the default ATT MTU.
+
+import bisect
+import http.server
+import struct
+import threading
+
+STATS_VERSION = 1
+STATS_SUMMARY = 0x80 | STATS_VERSION
+VALUE = struct.Struct('>I')
+HISTOGRAM = struct.Struct('>IIII')
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+# bucket upper bounds in seconds, from 50 us to 1 s
+LATENCY_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """
+    Counts samples per bucket, with their sum and maximum. bounds are the bucket upper bounds,
+    samples above the last one go in an overflow bucket.
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return self.bounds[bucket] if bucket < len(self.bounds) else self.max
+        return 0.0
+
+
+class Stats:
+    """
+    A list of named metrics. Counters and gauges are read through a function when the stats
+    are encoded, histograms are owned here and recorded into directly.
+    """
+
+    def __init__(self, prefix='can_bridge', labels=None):
+        self.prefix = prefix
+        self.labels = labels or {}
+        self.metrics = []   # (name, kind, help, function or Histogram)
+
+    def counter(self, name, help, read):
+        self.metrics.append((name, COUNTER, help, read))
+
+    def gauge(self, name, help, read):
+        self.metrics.append((name, GAUGE, help, read))
+
+    def histogram(self, name, help, bounds=LATENCY_BOUNDS):
+        histogram = Histogram(bounds)
+        self.metrics.append((name, 'histogram', help, histogram))
+        return histogram
+
+    def encode(self):
+        value = bytearray([STATS_VERSION])
+        for name, kind, help, source in self.metrics:
+            if isinstance(source, Histogram):
+                value += HISTOGRAM.pack(
+                    source.count & 0xFFFFFFFF,
+                    *(min(int(v * 1000000), 0xFFFFFFFF) for v in
+                      (source.percentile(50), source.percentile(99), source.max)))
+            else:
+                value += VALUE.pack(int(source()) & 0xFFFFFFFF)
+        return bytes(value)
+
+    def encode_summary(self, names):
+        sources = dict((name, source) for name, kind, help, source in self.metrics)
+        value = bytearray([STATS_SUMMARY])
+        for name in names:
+            value += VALUE.pack(int(sources[name]()) & 0xFFFFFFFF)
+        return bytes(value)
+
+    def prometheus(self):
+        return prometheus([self])
+
+
+def label_text(labels, extra=None):
+    items = sorted(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % item for item in items)
+
+
+def prometheus(stats_list):
+    # Prometheus text format of several Stats with the same metrics, e.g. one per CAN bus,
+    # told apart by their labels
+    lines = []
+    for position, (name, kind, help, source) in enumerate(stats_list[0].metrics):
+        name = '%s_%s' % (stats_list[0].prefix, name)
+        if isinstance(source, Histogram):
+            lines.append('# HELP %s_seconds %s' % (name, help))
+            lines.append('# TYPE %s_seconds histogram' % name)
+            for stats in stats_list:
+                histogram = stats.metrics[position][3]
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_seconds_bucket%s %d' % (name, label_text(stats.labels, ('le', '%g' % bound)), cumulative))
+                lines.append('%s_seconds_bucket%s %d' % (name, label_text(stats.labels, ('le', '+Inf')), histogram.count))
+                lines.append('%s_seconds_sum%s %.9f' % (name, label_text(stats.labels), histogram.total))
+                lines.append('%s_seconds_count%s %d' % (name, label_text(stats.labels), histogram.count))
+        else:
+            if kind == COUNTER:
+                name += '_total'
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for stats in stats_list:
+                lines.append('%s%s %d' % (name, label_text(stats.labels), stats.metrics[position][3]()))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusHandler(http.server.BaseHTTPRequestHandler):
+    stats = None
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = prometheus(self.stats).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(stats, port, host='127.0.0.1'):
+    # serves http://host:port/metrics from a daemon thread, returns the server.
+    # stats is a Stats or a list of them with the same metrics.
+    if isinstance(stats, Stats):
+        stats = [stats]
+    handler = type('StatsHandler', (PrometheusHandler,), {'stats': stats})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+#
+# Wire encodings of CAN frames carried in CAN characteristic values and notifications.
+#
+# Two formats are supported:
+#
+# legacy:  fixed size 13 byte records, a 4 byte big endian id, 1 byte data length and 8 data
+#          bytes padded with zeros. There is no header and no timestamp.
+#
+# compact: a 5 byte header followed by variable length records.
+#          header: 1 byte version (high nibble) and flags (low nibble), then the 4 byte big
+#                  endian base timestamp in microseconds, modulo 2**32
+#          record: timestamp delta in microseconds from the previous record (the base for the
+#                  first one) as a zigzag encoded LEB128 varint (0, -1, 1, -2, ... are sent
+#                  as 0, 1, 2, 3, ...), then the id, then the data bytes. Deltas are signed
+#                  because the scheduler in can_bridge.py interleaves ids, so frames are not
+#                  always in time order.
+#                  Standard ids are 2 bytes: bit 15 clear, data length in bits 11-14 and the
+#                  11 bit id below. Extended ids are 4 bytes: bit 31 set and the 29 bit id
+#                  below, followed by a 1 byte data length.
+#
+# A compact payload always starts with a byte of 0x10 or more while a legacy record starts
+# with 0x00 (standard id) or 0x80 (extended id), so the phone can tell them apart.
+
+import struct
+
+FORMAT_LEGACY = 'legacy'
+FORMAT_COMPACT = 'compact'
+
+CAN_EFF_FLAG = 0x80000000   # set in an id to mark an extended (29 bit) frame
+CAN_SFF_MASK = 0x000007FF
+CAN_EFF_MASK = 0x1FFFFFFF
+
+RECORD = struct.Struct('>IB8s')
+RECORD_SIZE = RECORD.size
+
+COMPACT_VERSION = 2         # 1 had unsigned deltas
+COMPACT_HEADER = struct.Struct('>BI')
+STANDARD_ID = struct.Struct('>H')
+EXTENDED_ID = struct.Struct('>IB')
+MAX_VARINT_SIZE = 5         # enough for a delta of +/- (2**32 - 1) microseconds
+MAX_COMPACT_RECORD_SIZE = MAX_VARINT_SIZE + EXTENDED_ID.size + 8
+# the first record of a payload has a delta of 0 from the header, a 1 byte varint
+MIN_COMPACT_PAYLOAD = COMPACT_HEADER.size + 1 + EXTENDED_ID.size + 8
+MAX_DELTA_US = 0xFFFFFFFF
+
+
+def encode_record(can_id, data):
+    # '8s' zero pads data shorter than 8 bytes
+    return RECORD.pack(can_id, len(data), bytes(data))
+
+
+def check_frame(can_id, data):
+    # raises ValueError unless can_id is an 11 bit id, or a 29 bit id with CAN_EFF_FLAG and no
+    # other flags, and data fits in a classic CAN frame
+    if can_id & CAN_EFF_FLAG:
+        if can_id & ~(CAN_EFF_FLAG | CAN_EFF_MASK):
+            raise ValueError("invalid extended id %08x" % can_id)
+    elif can_id & ~CAN_SFF_MASK:
+        raise ValueError("invalid standard id %x" % can_id)
+    if len(data) > 8:
+        raise ValueError("%d data bytes, at most 8 fit in a frame" % len(data))
+
+
+def decode_records(payload):
+    # yields (can_id, data) for every record in a legacy notification
+    for can_id, length, data in RECORD.iter_unpack(payload):
+        yield can_id, data[:length]
+
+
+def zigzag(delta):
+    # signed delta to the unsigned number sent as a varint
+    return delta << 1 if delta >= 0 else (-delta << 1) - 1
+
+
+def compact_record_size(can_id, length, delta_us):
+    # bytes taken by a compact record with length data bytes, delta_us after the previous one
+    size = (zigzag(delta_us).bit_length() + 6) // 7 or 1
+    return size + (EXTENDED_ID.size if can_id & CAN_EFF_FLAG else STANDARD_ID.size) + length
+
+
+class RecordEncoder:
+    """
+    Packs frames in the legacy fixed size record format.
+    """
+    format = FORMAT_LEGACY
+    header_size = 0
+
+    def payload_size(self, limit):
+        # largest payload not above limit that holds a whole number of records
+        return max(1, limit // RECORD_SIZE) * RECORD_SIZE
+
+    def begin(self, buf, timestamp):
+        # returns the offset of the first record
+        return 0
+
+    def pack_into(self, buf, offset, can_id, data, timestamp):
+        # returns the offset after the record, or -1 if it does not fit in buf
+        end = offset + RECORD_SIZE
+        if end > len(buf):
+            return -1
+        RECORD.pack_into(buf, offset, can_id, len(data), data)
+        return end
+
+    def encode(self, can_id, data, timestamp):
+        return encode_record(can_id, data)
+
+
+class CompactEncoder:
+    """
+    Packs frames in the compact format, see the top of this file.
+    """
+    format = FORMAT_COMPACT
+    header_size = COMPACT_HEADER.size
+
+    def __init__(self):
+        self.flags = 0
+        self.last_us = 0
+
+    def payload_size(self, limit):
+        # a frame that does not fit starts a new payload with itself as the base, so any limit
+        # of at least MIN_COMPACT_PAYLOAD (19 bytes, below the 20 of the smallest ATT MTU)
+        # holds a record
+        if limit < MIN_COMPACT_PAYLOAD:
+            raise ValueError("%d bytes cannot hold a compact record" % limit)
+        return limit
+
+    def begin(self, buf, timestamp):
+        self.last_us = int(timestamp * 1000000)
+        COMPACT_HEADER.pack_into(buf, 0, (COMPACT_VERSION << 4) | self.flags, self.last_us & 0xFFFFFFFF)
+        return COMPACT_HEADER.size
+
+    def pack_into(self, buf, offset, can_id, data, timestamp):
+        # returns the offset after the record, or -1 if it does not fit in buf. A frame more
+        # than MAX_DELTA_US from the previous one does not fit either, so it starts a new
+        # payload with a fresh base.
+        us = int(timestamp * 1000000)
+        delta = us - self.last_us
+        if delta > MAX_DELTA_US or delta < -MAX_DELTA_US:
+            return -1
+        length = len(data)
+        end = offset + compact_record_size(can_id, length, delta)
+        delta = zigzag(delta)
+        if end > len(buf):
+            return -1
+        while delta >= 0x80:
+            buf[offset] = (delta & 0x7F) | 0x80
+            delta >>= 7
+            offset += 1
+        buf[offset] = delta
+        offset += 1
+        if can_id & CAN_EFF_FLAG:
+            EXTENDED_ID.pack_into(buf, offset, CAN_EFF_FLAG | (can_id & CAN_EFF_MASK), length)
+            offset += EXTENDED_ID.size
+        else:
+            STANDARD_ID.pack_into(buf, offset, (length << 11) | (can_id & CAN_SFF_MASK))
+            offset += STANDARD_ID.size
+        buf[offset:end] = data
+        self.last_us = us
+        return end
+
+    def encode(self, can_id, data, timestamp):
+        buf = bytearray(COMPACT_HEADER.size + MAX_COMPACT_RECORD_SIZE)
+        end = self.pack_into(buf, self.begin(buf, timestamp), can_id, data, timestamp)
+        return bytes(buf[:end])
+
+
+def make_encoder(wire_format):
+    if wire_format == FORMAT_LEGACY:
+        return RecordEncoder()
+    if wire_format == FORMAT_COMPACT:
+        return CompactEncoder()
+    raise ValueError("unknown wire format '%s'" % wire_format)
+
+
+def is_compact(payload):
+    return len(payload) >= COMPACT_HEADER.size and payload[0] >> 4 == COMPACT_VERSION
+
+
+def decode_compact(payload):
+    # yields (timestamp_us, can_id, data) for every record in a compact notification.
+    # timestamp_us is modulo 2**32 like the header, can_id has CAN_EFF_FLAG set for extended frames.
+    version_flags, timestamp_us = COMPACT_HEADER.unpack_from(payload)
+    if version_flags >> 4 != COMPACT_VERSION:
+        raise ValueError("unsupported compact format version %d" % (version_flags >> 4))
+    offset = COMPACT_HEADER.size
+    end = len(payload)
+    while offset < end:
+        delta = 0
+        shift = 0
+        while True:
+            byte = payload[offset]
+            offset += 1
+            delta |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        delta = (delta >> 1) ^ -(delta & 1)
+        timestamp_us = (timestamp_us + delta) & 0xFFFFFFFF
+        if payload[offset] & 0x80:
+            can_id, length = EXTENDED_ID.unpack_from(payload, offset)
+            offset += EXTENDED_ID.size
+        else:
+            word = STANDARD_ID.unpack_from(payload, offset)[0]
+            can_id = word & CAN_SFF_MASK
+            length = word >> 11
+            offset += STANDARD_ID.size
+        if offset + length > end:
+            raise ValueError("truncated record")
+        yield timestamp_us, can_id, bytes(payload[offset:offset + length])
+        offset += length
+
+
+def decode(payload):
+    # yields (timestamp_us, can_id, data) whichever format the payload is in.
+    # timestamp_us is None for legacy payloads which carry no time.
+    if is_compact(payload):
+        yield from decode_compact(payload)
+    else:
+        for can_id, data in decode_records(payload):
+            yield None, can_id, data
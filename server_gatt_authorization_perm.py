@@ -6,6 +6,7 @@ import bluetooth_constants
 import bluetooth_gatt
 import bluetooth_utils
 import bluetooth_exceptions
+import bluetooth_log
 import dbus
 import dbus.exceptions
 import dbus.service
@@ -21,6 +22,9 @@ adapter_path = None
 adv_mgr_interface = None
 connected = 0
 
+log = bluetooth_log.get_logger('gatt')
+adv_log = bluetooth_log.get_logger('adv')
+
 approved_strings = ['hello' , 'goodbye', 'cheese']
 
 # much of this code was copied or inspired by test\example-advertisement in the BlueZ source
@@ -66,7 +70,7 @@ class Advertisement(dbus.service.Object):
         if self.data is not None:
             properties['Data'] = dbus.Dictionary(
                 self.data, signature='yv')
-        print(properties)
+        adv_log.debug("Advertisement properties: %s", properties)
         return {bluetooth_constants.ADVERTISING_MANAGER_INTERFACE: properties}
 
     def get_path(self):
@@ -84,53 +88,25 @@ class Advertisement(dbus.service.Object):
                          in_signature='',
                          out_signature='')
     def Release(self):
-        print('%s: Released' % self.path)
+        adv_log.info("%s: Released", self.path)
 
 
-class Application(dbus.service.Object):
-    """
-    org.bluez.GattApplication1 interface implementation
-    """
+class Application(bluetooth_gatt.Application):
     def __init__(self, bus):
-        self.path = '/'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-        print("Adding TemperatureService to the Application")
+        bluetooth_gatt.Application.__init__(self, bus)
+        log.info("Adding TemperatureService to the Application")
         self.add_service(TemperatureService(bus, '/org/bluez/ldsg', 0))
         self.add_service(LedService(bus, '/org/bluez/ldsg', 1))
 
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_service(self, service):
-        self.services.append(service)
-
-    @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        print('GetManagedObjects')
-
-        for service in self.services:
-            print("GetManagedObjects: service="+service.get_path())
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-
-        return response
-
 class TemperatureService(bluetooth_gatt.Service):
 #   Fake micro:bit temperature service that simulates temperature sensor measurements
 #   ref: https://lancaster-university.github.io/microbit-docs/resources/bluetooth/bluetooth_profile.html
 #   temperature_period characteristic not implemented to keep things simple
 
      def __init__(self, bus, path_base, index):
-        print("Initialising TemperatureService object")
+        log.info("Initialising TemperatureService object")
         bluetooth_gatt.Service.__init__(self, bus, path_base, index, bluetooth_constants.TEMPERATURE_SVC_UUID, True)
-        print("Adding TemperatureCharacteristic to the service")
+        log.info("Adding TemperatureCharacteristic to the service")
         self.add_characteristic(TemperatureCharacteristic(bus, 0, self))
 
 class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
@@ -147,7 +123,7 @@ class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
                 service)
         self.notifying = False
         self.temperature = random.randint(0, 50)
-        print("Initial temperature set to "+str(self.temperature))
+        log.info("Initial temperature set to %s", self.temperature)
         self.delta = 0
         timer_id = GLib.timeout_add(1000, self.simulate_temperature)
 
@@ -158,15 +134,15 @@ class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
             self.temperature = 50
         elif (self.temperature < 0):
             self.temperature = 0     
-        # print("simulated temperature: "+str(self.temperature)+"C")
+        # log.debug("simulated temperature: %sC", self.temperature)
         if self.notifying:
             self.notify_temperature()
 
         GLib.timeout_add(1000, self.simulate_temperature)
 
     def ReadValue(self, options):
-        print('ReadValue in TemperatureCharacteristic called')
-        print('Returning '+str(self.temperature))
+        log.debug("ReadValue in TemperatureCharacteristic called")
+        log.debug("Returning %s", self.temperature)
         value = []
         value.append(dbus.Byte(self.temperature))
         return value
@@ -179,18 +155,18 @@ class TemperatureCharacteristic(bluetooth_gatt.Characteristic):
         value = []
         value.append(dbus.Byte(self.temperature))
         if self.notifying:
-            print("notifying temperature="+str(self.temperature))
+            log.debug("notifying temperature=%s", self.temperature)
         self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, { 'Value': value }, [])
         return self.notifying
 
     # note this overrides the same method in bluetooth_gatt.Characteristic where it is exported to 
     # make it visible over DBus
     def StartNotify(self):
-        print("starting notifications")
+        log.info("starting notifications")
         self.notifying = True
 
     def StopNotify(self):
-        print("stopping notifications")
+        log.info("stopping notifications")
         self.notifying = False
 
 class LedService(bluetooth_gatt.Service):
@@ -199,9 +175,9 @@ class LedService(bluetooth_gatt.Service):
 #   LED Matrix characteristic not implemented to keep things simple
 
      def __init__(self, bus, path_base, index):
-        print("Initialising LedService object")
+        log.info("Initialising LedService object")
         bluetooth_gatt.Service.__init__(self, bus, path_base, index, bluetooth_constants.LED_SVC_UUID, True)
-        print("Adding LedTextharacteristic to the service")
+        log.info("Adding LedTextharacteristic to the service")
         self.add_characteristic(LedTextCharacteristic(bus, 0, self))
 
 class LedTextCharacteristic(bluetooth_gatt.Characteristic):
@@ -225,35 +201,35 @@ class LedTextCharacteristic(bluetooth_gatt.Characteristic):
     def WriteValue(self, value, options):
         ascii_bytes = bluetooth_utils.dbus_to_python(value)
         ascii = ''.join(chr(i) for i in ascii_bytes)
-        print(str(ascii_bytes) + " = " + ascii)
+        log.info("%s = %s", ascii_bytes, ascii)
         if self.authorized(ascii):
-            print("authorized")
+            log.info("authorized")
             text = ascii
         else:
-            print("Not authorized")
+            log.info("Not authorized")
             raise bluetooth_exceptions.NotAuthorizedException()
 
 def register_ad_cb():
-    print('Advertisement registered OK')
+    adv_log.info("Advertisement registered OK")
 
 def register_ad_error_cb(error):
-    print('Error: Failed to register advertisement: ' + str(error))
+    adv_log.error("Failed to register advertisement: %s", error)
     mainloop.quit()
 
 def register_app_cb():
-    print('GATT application registered')
+    log.info("GATT application registered")
 
 def register_app_error_cb(error):
-    print('Failed to register application: ' + str(error))
+    log.error("Failed to register application: %s", error)
     mainloop.quit()
 
 def set_connected_status(status):
     if (status == 1):
-        print("connected")
+        log.info("connected")
         connected = 1
         stop_advertising()
     else:
-        print("disconnected")
+        log.info("disconnected")
         connected = 0
         start_advertising()
 
@@ -262,7 +238,7 @@ def properties_changed(interface, changed, invalidated, path):
         if ("Connected" in changed):
             set_connected_status(changed["Connected"])
         if ("RSSI" in changed):
-            print("RSSI: "+str(changed["RSSI"]))
+            log.debug("RSSI: %s", changed["RSSI"])
 
 def interfaces_added(path, interfaces):
     if bluetooth_constants.DEVICE_INTERFACE in interfaces:
@@ -270,19 +246,19 @@ def interfaces_added(path, interfaces):
         if ("Connected" in properties):
             set_connected_status(properties["Connected"])
         if ("Address" in properties):
-            print(properties["Address"])
+            log.info("%s", properties["Address"])
 
 def stop_advertising():
     global adv
     global adv_mgr_interface
-    print("Unregistering advertisement",adv.get_path())
+    adv_log.info("Unregistering advertisement %s", adv.get_path())
     adv_mgr_interface.UnregisterAdvertisement(adv.get_path())
 
 def start_advertising():
     global adv
     global adv_mgr_interface
     # we're only registering one advertisement object so index (arg2) is hard coded as 0
-    print("Registering advertisement",adv.get_path())
+    adv_log.info("Registering advertisement %s", adv.get_path())
     adv_mgr_interface.RegisterAdvertisement(adv.get_path(), {},
                                         reply_handler=register_ad_cb,
                                         error_handler=register_ad_error_cb)
@@ -316,7 +292,7 @@ app = Application(bus)
 
 mainloop = GLib.MainLoop()
 
-print('Registering GATT application...')
+log.info("Registering GATT application...")
 
 service_manager.RegisterApplication(app.get_path(), {},
                                 reply_handler=register_app_cb,